@@ -6,10 +6,20 @@ import os
 import subprocess
 import cgi
 import re
+import fcntl
+import errno
+import gobject
 
 class FindInProjectParser:
+    # grep -Z ends the filename with a NUL byte; ack cannot do that, and its
+    # plain "file:line:text" and "file-line-text" lines are split at the first
+    # line number, match lines first, that leaves the name of an existing file
+    grep_line = re.compile('^(?P<file>[^\0]*)\0(?P<line>\d+)(?P<sep>[:-])(?P<text>.*)$', re.S)
+    ack_sep = re.compile(r'(?=([:-])(\d+)\1)')
 
-    def __init__(self, query, path, context=True, regex=False, ignorecase=False, filetype=None):
+    # with stream=True nothing runs until start(), which reads the output as
+    # it arrives and hands the html of every finished block to a callback
+    def __init__(self, query, path, context=True, regex=False, ignorecase=False, filetype=None, stream=False):
         if filetype:
             filetype = filetype.replace(' ', '').split(',')
         ack = ""
@@ -19,7 +29,7 @@ class FindInProjectParser:
             ack = "ack"
 
         if ack:
-            arg = [ack, '--color', '--color-filename=reset', '--color-match=yellow', query]
+            arg = [ack, '--nocolor', '--nogroup', '-H', query]
             if context:
                 arg.extend(['-C', '2'])
             if not regex:
@@ -29,11 +39,9 @@ class FindInProjectParser:
             if filetype:
                 filetype = ['.' + f for f in filetype]
                 arg.extend(['--type-set', 'custom=%s' % ','.join(filetype), '--type=custom'])
-            process = subprocess.Popen(arg, stdout=subprocess.PIPE, cwd=path)
-            self.raw = cgi.escape(process.communicate()[0])
-            self.raw = self.raw.replace('\x1b[0m\x1b[K','')
+            self._split = self.__split_ack
         else:
-            arg = ['grep', '-R', '-n', '-H', '-I', query, '.', '--color=force']
+            arg = ['grep', '-R', '-n', '-H', '-I', '-Z', '--color=never', '-e', query, '.']
             if context:
                 arg.extend(['-C', '2'])
             if regex:
@@ -42,11 +50,100 @@ class FindInProjectParser:
                 arg.append('-i')
             if filetype:
                 arg.extend(['--include=*.%s' % t for t in filetype])
-            process = subprocess.Popen(arg, stdout=subprocess.PIPE, cwd=path,env={"GREP_COLORS": "ms=33:mc=01;31:sl=:cx=:fn=0:ln=:bn=32:se="})
-            self.raw = cgi.escape(process.communicate()[0])
-            self.raw = self.raw.replace('\x1b[K', '')
-        self.filelist = []
+            self._split = self.__split_grep
+        # matches are highlighted here instead of by the tool's color codes
+        flags = 0
+        if ignorecase:
+            flags = re.I
+        if not regex:
+            query = re.escape(query)
+        try:
+            self._highlight = re.compile(query, flags)
+        except re.error:
+            self._highlight = None
+        self._path = path
+        self._isfile = {} # prefix of an ack line -> whether it is a file
+        self._popen_args = dict(args=arg, stdout=subprocess.PIPE, cwd=path)
+        self._process = None
+        self._watch = None
+        self.filelist = set()
         self.matches = 0
+        if not stream:
+            process = subprocess.Popen(**self._popen_args)
+            self.raw = process.communicate()[0]
+
+    def start(self, on_html, on_finished):
+        self._on_html = on_html
+        self._on_finished = on_finished
+        self._buffer = ''
+        self._block = []
+        self._process = subprocess.Popen(**self._popen_args)
+        fd = self._process.stdout.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._watch = gobject.io_add_watch(fd, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, self.__read, priority=gobject.PRIORITY_LOW)
+
+    def cancel(self):
+        if self._watch:
+            gobject.source_remove(self._watch)
+            self._watch = None
+        if self._process:
+            try:
+                self._process.kill()
+            except OSError:
+                pass
+            self._process.wait()
+            self._process = None
+
+    def running(self):
+        return self._watch is not None
+
+    def __read(self, fd, condition):
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return True
+            data = ''
+        if data:
+            lines = (self._buffer + data).split('\n')
+            self._buffer = lines.pop()
+            html = self.__feed(lines)
+            if html:
+                self._on_html(html)
+            return True
+        # end of output
+        html = self.__feed([self._buffer]) + self.__end_block()
+        self._buffer = ''
+        self._watch = None
+        self._process.wait()
+        self._process = None
+        if html:
+            self._on_html(html)
+        self._on_finished()
+        return False
+
+    # a block ends at a "--" separator line or where the filename changes
+    def __feed(self, lines):
+        html = ''
+        for l in lines:
+            if l == '--':
+                html += self.__end_block()
+                continue
+            if not l:
+                continue
+            meta = self.__metadata(l)
+            if not meta:
+                continue
+            if self._block and self._block[0][0] != meta[0]:
+                html += self.__end_block()
+            self._block.append(meta)
+        return html
+
+    def __end_block(self):
+        if not self._block:
+            return ''
+        block, self._block = self._block, []
+        return self.__table(block)
 
     def status(self):
         return (self.matches, len(self.filelist))
@@ -57,7 +154,11 @@ class FindInProjectParser:
         if not blocks or len(blocks[0]) == 0:
             return result
         for block in blocks:
-            table = """
+            result += self.__table(block)
+        return result
+
+    def __table(self, block):
+        table = """
 <table>
     <colgroup class="line-number"></colgroup>
     <colgroup class="code"></colgroup>
@@ -67,30 +168,29 @@ class FindInProjectParser:
         </tr>
     </thead>
     <tbody>
-            """ % os.path.normpath(block[0][0])
-            for line in block:
-                matchclass = ""
-                if line[2]:
-                    matchclass = ' match'
-                table += """
+        """ % os.path.normpath(block[0][0])
+        for line in block:
+            matchclass = ""
+            if line[2]:
+                matchclass = ' match'
+            table += """
         <tr onclick="javascript:goto('%s', %s)">
             <td class="line-number%s">%s</td>
             <td class="code%s">%s</td>
         </tr>
-                """ % (line[0], line[1], matchclass, line[1], matchclass, line[3])
-            table += """
+            """ % (line[0], line[1], matchclass, line[1], matchclass, line[3])
+        table += """
     </tbody>
 </table>
-            """
-            result += table
-        return result
+        """
+        return table
 
     def __tuple(self):
-        #\x1b[0mew\x1b[0m-64-
-        #\x1b[0mew\x1b[0m-65-
-        #\x1b[0mew\x1b[0m:66:if __name__ == "\x1b[33m__main__\x1b[0m":\x1b[0m\x1b[K
-        #\x1b[0mew\x1b[0m-67-    Eastwind()
-        #\x1b[0mew\x1b[0m-68-
+        #./ew\x0064-
+        #./ew\x0065-
+        #./ew\x0066:if __name__ == "__main__":
+        #./ew\x0067-    Eastwind()
+        #./ew\x0068-
 
         groups = re.split('(?<=\n)--\n', self.raw)
         if groups and len(groups) == 1:
@@ -99,22 +199,70 @@ class FindInProjectParser:
                 if not l:
                     continue
                 meta = self.__metadata(l)
+                if not meta:
+                    continue
                 if meta[0] in filename_hash:
                     filename_hash[meta[0]].append(meta)
                 else:
                     filename_hash[meta[0]] = [meta]
             return [filename_hash[k] for k in filename_hash.keys()]
         else:
-            return [[self.__metadata(l) for l in g.split('\n') if l != ''] for g in groups]
+            return [[m for m in [self.__metadata(l) for l in g.split('\n') if l != ''] if m] for g in groups]
+
+    def __split_grep(self, line):
+        match = self.grep_line.match(line)
+        if not match:
+            return None
+        return match.group('file', 'sep', 'line', 'text')
+
+    def __split_ack(self, line):
+        seps = sorted(self.ack_sep.finditer(line), key=lambda m: (m.group(1) != ':', m.start()))
+        if not seps:
+            return None
+        for sep in seps:
+            if self.__isfile(line[:sep.start()]):
+                break
+        else:
+            sep = seps[0]
+        return (line[:sep.start()], sep.group(1), sep.group(2), line[sep.end(2)+1:])
+
+    # files already in the results, and prefixes seen before, need no stat
+    def __isfile(self, name):
+        if name in self.filelist:
+            return True
+        isfile = self._isfile.get(name)
+        if isfile is None:
+            isfile = self._isfile[name] = os.path.isfile(os.path.join(self._path, name))
+        return isfile
 
     def __metadata(self, line):
-        match = re.match("^\\x1b\[0m(.*?)\\x1b\[0?m[:-](\d+)([:-])(.*)", line)
-        matched = (match.group(3) == ':')
-        clear = match.group(4).replace(' ', '&nbsp;')
-        clear = re.sub("\\x1b\[33m(.*?)\\x1b\[0?m", '<span class="highlight">\\1</span>', clear)
+        parts = self._split(line)
+        if not parts:
+            return None
+        filename, sep, number, text = parts
+        matched = (sep == ':')
         if matched:
             self.matches = self.matches + 1
-        if not match.group(1) in self.filelist:
-            self.filelist.append(match.group(1))
-        return (match.group(1), match.group(2), matched, clear)
+            clear = self.__highlighted(text)
+        else:
+            clear = self.__escape(text)
+        self.filelist.add(filename)
+        return (cgi.escape(filename), number, matched, clear)
+
+    def __highlighted(self, text):
+        if not self._highlight:
+            return self.__escape(text)
+        result = []
+        last = 0
+        for match in self._highlight.finditer(text):
+            if match.end() == match.start():
+                continue
+            result.append(self.__escape(text[last:match.start()]))
+            result.append('<span class="highlight">%s</span>' % self.__escape(match.group()))
+            last = match.end()
+        result.append(self.__escape(text[last:]))
+        return ''.join(result)
+
+    def __escape(self, text):
+        return cgi.escape(text).replace(' ', '&nbsp;')
 
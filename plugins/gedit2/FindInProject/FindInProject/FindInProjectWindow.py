@@ -4,6 +4,7 @@ import webkit
 import pygtk
 import os
 import re
+import json
 from urllib import url2pathname
 from FindInProjectParser import FindInProjectParser
 from FindInProjectUtil import filebrowser_root
@@ -49,6 +50,9 @@ tbody tr:nth-child(even) td:nth-child(2){
 }
 </style>
 <script type="text/javascript">
+function append(html) {
+  document.getElementById('results').insertAdjacentHTML('beforeend', html);
+}
 function goto(file, line) {
   window.location = "gedit:///" + file + "?line=" + line;
 }
@@ -64,7 +68,8 @@ function toggle(dom) {
     triangle.className = 'open';
   }
 }
-</script>"""
+</script>
+<div id="results"></div>"""
 
 class FindInProjectBrowser(webkit.WebView):
     def __init__(self):
@@ -72,6 +77,8 @@ class FindInProjectBrowser(webkit.WebView):
 
 class FindInProjectWindow:
     protocol = re.compile(r'(?P<protocol>^gedit:\/\/)(?P<file>.*?)\?line=(?P<line>.*?)$')
+    # results arrive in many small pieces, so they are added to the page in batches
+    flush_interval = 100
 
     def __init__(self, gedit_window):
         self._gedit_window = gedit_window
@@ -80,12 +87,15 @@ class FindInProjectWindow:
         self._window = self._builder.get_object("find-in-project")
         self._browser = FindInProjectBrowser()
         self._browser.connect("navigation-requested", self.goto_file)
+        self._browser.connect("load-finished", self.page_loaded)
         self._window.connect("delete_event", self._window.hide_on_delete)
         self._window.connect("key-release-event", self.window_key)
         self._searchbox = self._builder.get_object("searchbox")
         self._searchbox.connect("key-release-event", self.box_key)
         self._searchbox.connect("icon-release", self.box_clear)
         self._builder.get_object("search-button").connect("clicked", self.search)
+        self._cancel_button = self._builder.get_object("cancel-button")
+        self._cancel_button.connect("clicked", self.cancel)
         self._builder.get_object("placeholder").add(self._browser)
         self._history = gtk.ListStore(gobject.TYPE_STRING)
         self._completion = gtk.EntryCompletion()
@@ -101,6 +111,10 @@ class FindInProjectWindow:
         self._extbox.connect("key-release-event", self.box_key)
         self._spinner = self._builder.get_object("spinner")
         self._searched = []
+        self._parser = None
+        self._page_ready = False
+        self._pending_html = []
+        self._flush_id = None
 
     def init(self):
         self._window.deiconify()
@@ -136,17 +150,71 @@ class FindInProjectWindow:
         query = self._searchbox.get_text()
         if not query:
             return True
+        self.stop()
         self._message.set_text('Loading...')
         self._spinner.show()
         self._spinner.start()
-        gtk.gdk.window_process_all_updates()
+        self._cancel_button.set_sensitive(True)
         self._path = filebrowser_root()
         if not query in self._searched:
             self._history.set(self._history.append(), 0, query)
             self._searched.append(query)
-        parser = FindInProjectParser(query, url2pathname(self._path)[7:], context=self._show_context.get_active(), regex=self._use_regex.get_active(), ignorecase=self._ignore_case.get_active(), filetype=self._extbox.get_text())
-        self._browser.load_string(style_str + parser.html(), "text/html", "utf-8", "about:")
-        self._message.set_text('%d line(s) matched in %d file(s)' % parser.status())
+        self._page_ready = False
+        self._browser.load_string(style_str, "text/html", "utf-8", "about:")
+        self._parser = FindInProjectParser(query, url2pathname(self._path)[7:], context=self._show_context.get_active(), regex=self._use_regex.get_active(), ignorecase=self._ignore_case.get_active(), filetype=self._extbox.get_text(), stream=True)
+        self._parser.start(self.add_results, self.search_finished)
+
+    def cancel(self, button):
+        if self._parser:
+            self.stop()
+            self._message.set_text('Cancelled, %d line(s) matched in %d file(s)' % self._status)
+
+    def stop(self):
+        if self._parser:
+            self._parser.cancel()
+            self._status = self._parser.status()
+            self._parser = None
+        self._pending_html = []
+        if self._flush_id:
+            gobject.source_remove(self._flush_id)
+            self._flush_id = None
+        self._cancel_button.set_sensitive(False)
+        self._spinner.stop()
+        self._spinner.hide()
+
+    def add_results(self, html):
+        self._pending_html.append(html)
+        self._message.set_text('Searching... %d line(s) matched in %d file(s)' % self._parser.status())
+        if not self._flush_id:
+            self._flush_id = gobject.timeout_add(self.flush_interval, self.flush_results)
+
+    def search_finished(self):
+        status = self._parser.status()
+        self._parser = None
+        self._cancel_button.set_sensitive(False)
         self._spinner.stop()
         self._spinner.hide()
+        self._message.set_text('%d line(s) matched in %d file(s)' % status)
+        self.flush_now()
+
+    def page_loaded(self, view, frame):
+        self._page_ready = True
+        self.flush_now()
+
+    def flush_now(self):
+        if self._flush_id:
+            gobject.source_remove(self._flush_id)
+            self._flush_id = None
+        self.flush_results()
+
+    def flush_results(self):
+        if not self._page_ready:
+            # keep the timeout running until the page can take the results
+            return self._flush_id is not None
+        if self._pending_html:
+            html = unicode(''.join(self._pending_html), 'utf-8', 'replace')
+            self._pending_html = []
+            self._browser.execute_script('append(%s);' % json.dumps(html))
+        self._flush_id = None
+        return False
 
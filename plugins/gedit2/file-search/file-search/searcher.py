@@ -20,8 +20,10 @@
 # Search functionality classes:
 # - LineSplitter (accumulates incoming strings and splits them into lines)
 # - RunCommand (runs a shell command and passes the output to LineSplitter)
-# - GrepProcess (uses RunCommand to run Grep, parses its output, and passes that to the result window)
-# - SearchProcess (uses RunCommand to run Find, parses its output, and starts GrepProcess)
+# - GrepChunk (collects the output of one Grep run on a chunk of files)
+# - GrepProcess (uses RunCommand to run several Greps at once, parses their output, and passes that to the result window in path order)
+# - SearchProcess (uses RunCommand to run Find, and passes its output to GrepProcess as it arrives)
+# - NativeSearchProcess (alternative to SearchProcess that walks and searches the files with threads inside Gedit, without Find and Grep)
 #
 
 
@@ -31,6 +33,11 @@ import fcntl
 import subprocess
 import re
 import errno
+import mmap
+import fnmatch
+import threading
+import Queue
+import heapq
 
 
 class LineSplitter:
@@ -136,18 +143,64 @@ def buildQueryRE (queryText, caseSensitive, wholeWord):
     return re.compile(pattern, flags)
 
 
+def foldedPattern (queryText):
+    "returns a RegEx pattern for the UTF-8 bytes of queryText in any case, also for non-ASCII letters"
+    parts = []
+    for c in queryText:
+        cases = set([c, c.lower(), c.upper()])
+        if ord(c) < 128 or len(cases) == 1:
+            parts.append(re.escape(c.encode("utf-8")))
+        else:
+            parts.append("(?:%s)" % "|".join([re.escape(v.encode("utf-8")) for v in sorted(cases)]))
+    return "".join(parts)
+
+
+def cpuCount ():
+    "returns the number of online CPUs (at least 1)"
+    try:
+        return max(1, os.sysconf("SC_NPROCESSORS_ONLN"))
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+
+class GrepChunk:
+    "Receives the output of one grep run and passes it on to its GrepProcess"
+    def __init__ (self, grepProcess, fileNames):
+        self.grepProcess = grepProcess
+        self.fileNames = fileNames
+        self.cmdRunner = None
+        self.results = {} # filename -> results
+
+    def handleLine (self, line):
+        self.grepProcess.handleChunkLine(self, line)
+
+    def handleFinished (self):
+        self.grepProcess.handleChunkFinished(self)
+
+
 class GrepProcess:
-    def __init__ (self, query, resultCb, finishedCb):
+    def __init__ (self, query, resultCb, finishedCb, maxProcesses=None):
         self.query = query
         self.resultCb = resultCb
         self.finishedCb = finishedCb
+        if maxProcesses is None:
+            maxProcesses = cpuCount()
+        self.maxProcesses = maxProcesses
 
         # Assume all file contents are in UTF-8 encoding (AFAIK grep will just search for byte sequences, it doesn't care about encodings):
         self.queryText = query.text.encode("utf-8")
 
         self.fileNames = []
-        self.cmdRunner = None
+        self.fileNameChars = 0
+        self.chunks = [] # running chunks
+        self.numRunning = 0
+        # Results are passed on in path order: they wait until find is done
+        # and every file before theirs (by pathCompare) has been grepped
+        self.allFiles = []
+        self.fileResults = {} # filename -> results, for grepped files
+        self.nextFile = 0 # index into the sorted allFiles of the next file to report
         self.cancelled = False
+        self.finished = False
         self.numGreps = 0
         self.inputFinished = False
 
@@ -157,57 +210,91 @@ class GrepProcess:
 
     def cancel (self):
         self.cancelled = True
-        if self.cmdRunner:
-            self.cmdRunner.cancel()
-            self.cmdRunner = None
-        pass
+        self.fileNames = []
+        for chunk in self.chunks:
+            if chunk.cmdRunner:
+                chunk.cmdRunner.cancel()
 
     def addFilename (self, filename):
+        if self.cancelled:
+            return
         self.fileNames.append(filename)
+        self.fileNameChars += len(filename)
+        self.allFiles.append(filename)
         self.runGrep()
 
     def handleInputFinished (self):
         "Called when there will be no more input files added"
         self.inputFinished = True
-        if not(self.cmdRunner):
-            # this can happen if no files at all are found
-            self.finishedCb()
+        self.allFiles.sort(pathCompare)
+        # the files not grepped yet are done in path order, so their results can follow as they come
+        self.fileNames.sort(pathCompare)
+        self.reportResults()
+        self.runGrep()
+        self.checkFinished()
 
-    def runGrep (self):
-        if self.cmdRunner or len(self.fileNames) == 0 or self.cancelled:
+    def reportResults (self):
+        if not(self.inputFinished):
             return
+        while self.nextFile < len(self.allFiles) and not(self.cancelled):
+            results = self.fileResults.pop(self.allFiles[self.nextFile], None)
+            if results is None:
+                break
+            for result in results:
+                self.resultCb(*result)
+            self.nextFile += 1
+
+    def checkFinished (self):
+        # this can happen if no files at all are found
+        if self.inputFinished and self.numRunning == 0 and len(self.fileNames) == 0 and not(self.finished):
+            self.finished = True
+            self.finishedCb()
 
+    def runGrep (self):
         # run Grep on many files at once:
         maxGrepFiles = 5000
-        maxGrepLine = 3800
-        fileNameList = []
-
-        i = 0
-        numChars = 0
-        for f in self.fileNames:
-            fileNameList += [f]
-            i+=1
-            numChars += len(f)
-            if i > maxGrepFiles or numChars > maxGrepLine:
+        maxGrepLine = min(100000, os.sysconf("SC_ARG_MAX") / 4)
+
+        while len(self.fileNames) > 0 and not(self.cancelled) and self.numRunning < self.maxProcesses:
+            # wait for a full chunk while find is still running, unless all greps are idle
+            chunkFull = len(self.fileNames) > maxGrepFiles or self.fileNameChars > maxGrepLine
+            if not(chunkFull or self.inputFinished or self.numRunning == 0):
                 break
-        self.fileNames = self.fileNames[i:]
 
-        self.numGreps += 1
-        #if self.numGreps % 100 == 0:
-            #print "ran %d greps so far" % self.numGreps
+            fileNameList = []
+            i = 0
+            numChars = 0
+            for f in self.fileNames:
+                fileNameList += [f]
+                i+=1
+                numChars += len(f)
+                if i > maxGrepFiles or numChars > maxGrepLine:
+                    break
+            self.fileNames = self.fileNames[i:]
+            self.fileNameChars -= numChars
 
-        grepCmd = ["grep", "-H", "-I", "-n", "-s", "-Z"]
-        if not(self.query.caseSensitive):
-            grepCmd += ["-i"]
-        if not(self.query.isRegExp):
-            grepCmd += ["-F"]
+            self.numGreps += 1
+            #if self.numGreps % 100 == 0:
+                #print "ran %d greps so far" % self.numGreps
 
-        grepCmd += ["-e", self.queryText]
-        grepCmd += fileNameList
+            grepCmd = ["grep", "-H", "-I", "-n", "-s", "-Z"]
+            if not(self.query.caseSensitive):
+                grepCmd += ["-i"]
+            if not(self.query.isRegExp):
+                grepCmd += ["-F"]
 
-        self.cmdRunner = RunCommand(grepCmd, self)
+            grepCmd += ["-e", self.queryText]
+            grepCmd += fileNameList
+
+            chunk = GrepChunk(self, fileNameList)
+            self.chunks.append(chunk)
+            self.numRunning += 1
+            chunk.cmdRunner = RunCommand(grepCmd, chunk)
+
+    def handleChunkLine (self, chunk, line):
+        if self.cancelled:
+            return
 
-    def handleLine (self, line):
         filename = None
         lineno = None
         linetext = ""
@@ -233,24 +320,27 @@ class GrepProcess:
                 self.postSearchPattern.search(linetext) is None:
                 return
 
-            self.resultCb(filename, lineno, linetext)
+            chunk.results.setdefault(filename, []).append((filename, lineno, linetext))
 
-    def handleFinished (self):
+    def handleChunkFinished (self, chunk):
         #print "grep finished"
-        self.cmdRunner = None
-        if len(self.fileNames) > 0 and not(self.cancelled):
-            self.runGrep()
-        else:
-            if self.inputFinished:
-                #print "ran %d greps" % self.numGreps
-                self.finishedCb()
+        chunk.cmdRunner = None
+        self.chunks.remove(chunk)
+        self.numRunning -= 1
+
+        for f in chunk.fileNames:
+            self.fileResults[f] = chunk.results.get(f, [])
+        chunk.results = None
+        self.reportResults()
+
+        self.runGrep()
+        self.checkFinished()
 
 
 class SearchProcess:
     def __init__ (self, query, resultHandler):
         self.resultHandler = resultHandler
         self.cancelled = False
-        self.files = []
 
         self.grepProcess = GrepProcess(query, self.handleGrepResult, self.handleGrepFinished)
 
@@ -293,22 +383,12 @@ class SearchProcess:
         # Note: we don't assume anything about the encoding of output from `find`
         # but just treat it as encoding-less byte sequence.
 
-        self.files.append(line)
+        # grep starts on files while find is still running:
+        self.grepProcess.addFilename(line)
 
     def handleFinished (self):
-        #print "find finished (%d files found)" % len(self.files)
+        #print "find finished"
         self.cmdRunner = None
-
-        if self.cancelled:
-            self.resultHandler.handleFinished()
-            self.files = []
-            return
-
-        self.files.sort(pathCompare)
-
-        for f in self.files:
-            self.grepProcess.addFilename(f)
-        self.files = []
         self.grepProcess.handleInputFinished()
 
     def handleGrepResult (self, filename, lineno, linetext):
@@ -323,3 +403,210 @@ def pathCompare (p1, p2):
     s1 = os.path.split(p1)
     s2 = os.path.split(p2)
     return cmp(s1, s2)
+
+
+class NativeSearchProcess:
+    """
+    Searches the query directory inside Gedit: a walker thread lists the
+    files, a pool of worker threads searches them through mmap, and the
+    results are passed to the resultHandler from the main loop in walk order.
+    """
+    vcsDirs = ["CVS", ".svn", ".git", "RCS", ".bzr"]
+    binaryCheckSize = 32768 # like grep -I, a NUL byte in this prefix marks a binary file
+    pollInterval = 50 # ms
+    maxResultsPerPoll = 2000
+
+    def __init__ (self, query, resultHandler, numThreads=None):
+        self.query = query
+        self.resultHandler = resultHandler
+        self.cancelled = threading.Event()
+        self.finished = False
+
+        # Assume all file contents are in UTF-8 encoding:
+        queryText = query.text.encode("utf-8")
+        self.literal = None
+        if not(query.isRegExp) and query.caseSensitive:
+            self.literal = queryText
+        else:
+            # the files are searched as bytes, where re.IGNORECASE only folds
+            # ASCII letters; other letters of a plain text query are matched
+            # in any case by listing their cases, in a regular expression
+            # they only match as written
+            if query.isRegExp:
+                pattern = queryText
+            elif query.caseSensitive:
+                pattern = re.escape(queryText)
+            else:
+                pattern = foldedPattern(query.text)
+            flags = re.MULTILINE
+            if not(query.caseSensitive):
+                flags |= re.IGNORECASE
+            self.pattern = re.compile(pattern, flags)
+
+        self.postSearchPattern = None
+        if query.wholeWord:
+            self.postSearchPattern = buildQueryRE(query.text, query.caseSensitive, True)
+
+        self.fileTypes = None
+        if query.selectFileTypes:
+            self.fileTypes = query.parseFileTypeString() or None
+
+        # (index, filename) from the walker; (index, filename, results) or
+        # (total, None, None) when the walk is done, for the main loop
+        self.files = Queue.Queue(1000)
+        self.results = Queue.Queue()
+        self.pendingResults = {}
+        self.nextIndex = 0
+        self.numFiles = None
+
+        if numThreads is None:
+            numThreads = cpuCount()
+        gobject.threads_init()
+        self.threads = [threading.Thread(target=self.walk)]
+        for i in range(numThreads):
+            self.threads.append(threading.Thread(target=self.work))
+        for t in self.threads:
+            t.setDaemon(True)
+            t.start()
+
+        gobject.timeout_add(self.pollInterval, self.poll)
+
+    def cancel (self):
+        self.cancelled.set()
+
+    def destroy (self):
+        self.cancel()
+
+    def isIncluded (self, name, isDir):
+        if self.query.excludeHidden and name.startswith("."):
+            return False
+        if isDir:
+            return not(self.query.excludeVCS and name in self.vcsDirs)
+        if self.query.excludeBackup and (name.endswith("~") or fnmatch.fnmatch(name, ".#*.*")):
+            return False
+        if self.fileTypes:
+            for t in self.fileTypes:
+                if fnmatch.fnmatch(name, t):
+                    return True
+            return False
+        return True
+
+    def walk (self):
+        # the directory with the smallest path comes next, and its files in
+        # name order, which is the order of pathCompare
+        index = 0
+        dirs = [self.query.directory]
+        while dirs and not(self.cancelled.isSet()):
+            directory = heapq.heappop(dirs)
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    # symlinks to files are searched, symlinked directories are not followed (like find -xtype f)
+                    isLink = os.path.islink(path)
+                    isDir = os.path.isdir(path)
+                    isFile = os.path.isfile(path)
+                except OSError:
+                    continue
+                if isDir and not(isLink):
+                    if self.query.includeSubfolders and self.isIncluded(name, True):
+                        heapq.heappush(dirs, path)
+                elif isFile and self.isIncluded(name, False):
+                    self.files.put((index, path))
+                    index += 1
+        for t in self.threads[1:]:
+            self.files.put((None, None))
+        self.results.put((index, None, None))
+
+    def work (self):
+        while True:
+            index, filename = self.files.get()
+            if index is None:
+                return
+            results = []
+            try:
+                if not(self.cancelled.isSet()):
+                    results = self.searchFile(filename)
+            except (IOError, OSError, ValueError, mmap.error):
+                pass
+            finally:
+                # always report the file, or the ordered output would wait for it forever
+                self.results.put((index, filename, results))
+
+    def searchFile (self, filename):
+        f = open(filename, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            if data.find("\0", 0, self.binaryCheckSize) != -1:
+                return []
+            return self.searchData(data)
+        finally:
+            data.close()
+
+    def searchData (self, data):
+        results = []
+        lineno = 1
+        countedTo = 0
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if self.literal is not None:
+                matchPos = data.find(self.literal, pos)
+                if matchPos == -1:
+                    break
+            else:
+                match = self.pattern.search(data, pos)
+                if match is None:
+                    break
+                matchPos = match.start()
+            lineStart = data.rfind("\n", 0, matchPos) + 1
+            lineEnd = data.find("\n", matchPos)
+            if lineEnd == -1:
+                lineEnd = end
+            lineno += data[countedTo:lineStart].count("\n")
+            countedTo = lineStart
+            linetext = unicode(data[lineStart:lineEnd], 'utf8', 'replace').rstrip("\n\r")
+            if self.postSearchPattern is None or self.postSearchPattern.search(linetext) is not None:
+                results.append((lineno, linetext))
+            pos = lineEnd + 1
+            if self.cancelled.isSet():
+                break
+        return results
+
+    def poll (self):
+        "Passes results to the resultHandler in walk order; runs in the main loop"
+        if self.cancelled.isSet():
+            return self.finish()
+        numResults = 0
+        try:
+            while numResults < self.maxResultsPerPoll:
+                index, filename, results = self.results.get_nowait()
+                if filename is None:
+                    self.numFiles = index
+                else:
+                    self.pendingResults[index] = (filename, results)
+                while self.nextIndex in self.pendingResults:
+                    filename, results = self.pendingResults.pop(self.nextIndex)
+                    self.nextIndex += 1
+                    for lineno, linetext in results:
+                        self.resultHandler.handleResult(filename, lineno, linetext)
+                    numResults += len(results)
+        except Queue.Empty:
+            pass
+        if self.numFiles is not None and self.nextIndex == self.numFiles:
+            return self.finish()
+        return True
+
+    def finish (self):
+        if not(self.finished):
+            self.finished = True
+            self.resultHandler.handleFinished()
+        return False
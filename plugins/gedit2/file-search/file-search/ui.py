@@ -46,7 +46,7 @@ _ = t.ugettext
 ngettext = t.ungettext
 gtk.glade.bindtextdomain(APP_NAME, LOCALE_PATH)
 
-from searcher import SearchProcess, buildQueryRE
+from searcher import SearchProcess, NativeSearchProcess, buildQueryRE
 
 # only display remote directories in file chooser if GIO is available:
 onlyLocalPathes = False
@@ -136,6 +136,7 @@ class SearchQuery:
         self.excludeVCS = True
         self.selectFileTypes = False
         self.fileTypeString = ''
+        self.nativeSearch = False # search inside Gedit instead of running find/grep
 
     def parseFileTypeString (self):
         "Returns a list with the separate file globs from fileTypeString"
@@ -182,6 +183,11 @@ class SearchQuery:
         except:
             self.selectFileTypes = False
 
+        try:
+            self.nativeSearch = gclient.get_without_default(gconfBase+"/native_search").get_bool()
+        except:
+            self.nativeSearch = False
+
     def storeDefaults (self, gclient):
         gclient.set_bool(gconfBase+"/case_sensitive", self.caseSensitive)
         gclient.set_bool(gconfBase+"/whole_word", self.wholeWord)
@@ -191,6 +197,7 @@ class SearchQuery:
         gclient.set_bool(gconfBase+"/exclude_backup", self.excludeBackup)
         gclient.set_bool(gconfBase+"/exclude_vcs", self.excludeVCS)
         gclient.set_bool(gconfBase+"/select_file_types", self.selectFileTypes)
+        gclient.set_bool(gconfBase+"/native_search", self.nativeSearch)
 
 
 class FileSearchWindowHelper:
@@ -575,17 +582,34 @@ class FileSearcher:
     - displaying matches
     A FileSearcher object lives until its result panel is closed.
     """
+    flushInterval = 200 # ms between two batches of results added to the tree
+    maxLinesPerFlush = 1000 # result lines added to the tree in one batch
+    maxShownLines = 5000 # result lines shown before "show more" has to be used
+
     def __init__ (self, window, pluginHelper, query):
         self._window = window
         self.pluginHelper = pluginHelper
         self.pluginHelper.registerSearcher(self)
         self.query = query
-        self.files = {}
+        self.files = {} # file name -> tree iter, for the files shown in the tree
+        self.matchedFiles = set()
         self.numMatches = 0
         self.numLines = 0
         self.wasCancelled = False
         self.searchProcess = None
         self._collapseAll = False # if true, new nodes will be displayed collapsed
+        self._pendingResults = [] # results not added to the tree yet
+        self._hiddenResults = [] # results beyond the shown line limit
+        self._numShownLines = 0
+        self._shownLinesLimit = self.maxShownLines
+        self._flushId = None
+        self._moreIter = None # row that shows the hidden results when activated
+        self._searchFinished = False
+        self._finishedShown = False
+
+        self._countPattern = None
+        if not(query.isRegExp):
+            self._countPattern = buildQueryRE(query.text, query.caseSensitive, query.wholeWord)
 
         self._createResultPanel()
         self._updateSummary()
@@ -594,24 +618,22 @@ class FileSearcher:
         searchSummary = "<span size=\"smaller\">" + _("searching for <i>%(keywords)s</i> in <i>%(folder)s</i>") % {'keywords': escapeMarkup(query.text), 'folder': escapeMarkup(gobject.filename_display_name(query.directory))} + "</span>"
         self.treeStore.append(None, [searchSummary, '', 0])
 
-        self.searchProcess = SearchProcess(query, self)
+        if query.nativeSearch:
+            self.searchProcess = NativeSearchProcess(query, self)
+        else:
+            self.searchProcess = SearchProcess(query, self)
         self._updateSummary()
 
     def handleResult (self, file, lineno, linetext):
-        expandRow = False
-        if not(self.files.has_key(file)):
-            it = self._addResultFile(file)
-            self.files[file] = it
-            expandRow = True
+        # only count the result here; it is added to the tree in the next batch
+        self.matchedFiles.add(file)
+        if self._countPattern:
+            self.numMatches += len(self._countPattern.findall(linetext[:1000]))
         else:
-            it = self.files[file]
-        if self._collapseAll:
-            expandRow = False
-        self._addResultLine(it, lineno, linetext)
-        if expandRow:
-            path = self.treeStore.get_path(it)
-            self.treeView.expand_row(path, False)
-        self._updateSummary()
+            self.numMatches += 1
+        self.numLines += 1
+        self._pendingResults.append((file, lineno, linetext))
+        self._scheduleFlush()
 
     def handleFinished (self):
         #print "(finished)"
@@ -623,7 +645,77 @@ class FileSearcher:
         editBtn.hide()
         editBtn.set_label("gtk-edit")
 
+        self._searchFinished = True
+        if self._flushId is None:
+            self._showFinished()
+
+    def _scheduleFlush (self):
+        if self._flushId is None:
+            self._flushId = gobject.timeout_add(self.flushInterval, self._flushResults)
+
+    def _flushResults (self):
+        "Adds a batch of pending results to the tree; runs as a timeout handler"
+        if not(self.tree):
+            self._flushId = None
+            return False
+
+        newFiles = []
+        numAdded = 0
+        numDone = 0
+        for (file, lineno, linetext) in self._pendingResults:
+            if numAdded >= self.maxLinesPerFlush:
+                break
+            numDone += 1
+            if self._numShownLines >= self._shownLinesLimit:
+                self._hiddenResults.append((file, lineno, linetext))
+                continue
+            if not(self.files.has_key(file)):
+                it = self._addResultFile(file)
+                self.files[file] = it
+                newFiles.append(it)
+            self._addResultLine(self.files[file], lineno, linetext)
+            self._numShownLines += 1
+            numAdded += 1
+        del self._pendingResults[:numDone]
+
+        # expand new file rows once they have their lines, not once per line:
+        if not(self._collapseAll):
+            for it in newFiles:
+                self.treeView.expand_row(self.treeStore.get_path(it), False)
+        self._updateMoreRow()
+        self._updateSummary()
+
+        if self._pendingResults:
+            return True
+        self._flushId = None
+        if self._searchFinished:
+            self._showFinished()
+        return False
+
+    def _updateMoreRow (self):
+        numHidden = len(self._hiddenResults)
+        if numHidden == 0:
+            if self._moreIter:
+                self.treeStore.remove(self._moreIter)
+                self._moreIter = None
+            return
+        line = "<i>" + ngettext("%d more line not shown (activate to show more)", "%d more lines not shown (activate to show more)", numHidden) % numHidden + "</i>"
+        if self._moreIter:
+            self.treeStore.set_value(self._moreIter, 0, line)
+        else:
+            self._moreIter = self.treeStore.append(None, [line, '', -1])
+
+    def _showMoreResults (self):
+        self._shownLinesLimit = self._numShownLines + self.maxShownLines
+        self._pendingResults[0:0] = self._hiddenResults
+        self._hiddenResults = []
+        self._scheduleFlush()
+
+    def _showFinished (self):
         self._updateSummary()
+        if self._finishedShown:
+            return
+        self._finishedShown = True
 
         if self.wasCancelled:
             line = "<i><span foreground=\"red\">" + _("(search was cancelled)") + "</span></i>"
@@ -632,13 +724,13 @@ class FileSearcher:
         else:
             line = "<i>" + ngettext("found %d match", "found %d matches", self.numMatches) % self.numMatches
             line += ngettext(" (%d line)", " (%d lines)", self.numLines) % self.numLines
-            line += ngettext(" in %d file", " in %d files", len(self.files)) % len(self.files) + "</i>"
+            line += ngettext(" in %d file", " in %d files", len(self.matchedFiles)) % len(self.matchedFiles) + "</i>"
         self.treeStore.append(None, [line, '', 0])
 
     def _updateSummary (self):
         summary = ngettext("<b>%d</b> match", "<b>%d</b> matches", self.numMatches) % self.numMatches
-        summary += "\n" + ngettext("in %d file", "in %d files", len(self.files)) % len(self.files)
-        if self.searchProcess:
+        summary += "\n" + ngettext("in %d file", "in %d files", len(self.matchedFiles)) % len(self.matchedFiles)
+        if self.searchProcess or self._pendingResults:
             summary += u"\u2026" # ellipsis character
         self.tree.get_widget("lblNumMatches").set_label(summary)
 
@@ -686,7 +778,8 @@ class FileSearcher:
             directory = os.path.normpath(directory) + "/"
 
         line = "%s<b>%s</b>" % (escapeMarkup(directory), escapeMarkup(file))
-        it = self.treeStore.append(None, [line, filename, 0])
+        # keep new files above the "show more" row and the final summary line:
+        it = self.treeStore.insert_before(None, self._moreIter, [line, filename, 0])
         return it
 
     def _addResultLine (self, it, lineno, linetext):
@@ -695,13 +788,11 @@ class FileSearcher:
             linetext = linetext[:1000]
             addTruncationMarker = True
 
+        # matches and lines are counted in handleResult
         if not(self.query.isRegExp):
-            (linetext, numLineMatches) = escapeAndHighlight(linetext, self.query.text, self.query.caseSensitive, self.query.wholeWord)
-            self.numMatches += numLineMatches
+            linetext = escapeAndHighlight(linetext, self.query.text, self.query.caseSensitive, self.query.wholeWord)[0]
         else:
             linetext = escapeMarkup(linetext)
-            self.numMatches += 1
-        self.numLines += 1
 
         if addTruncationMarker:
             linetext += "</span><span size=\"smaller\"><i> [...]</i>"
@@ -710,6 +801,9 @@ class FileSearcher:
 
     def on_row_activated (self, widget, path, col):
         selectedIter = self.treeStore.get_iter(path)
+        if self._moreIter and self.treeStore.get_path(self._moreIter) == path:
+            self._showMoreResults()
+            return
         parentIter = self.treeStore.iter_parent(selectedIter)
         lineno = 0
         if parentIter == None:
@@ -739,6 +833,11 @@ class FileSearcher:
         if self.searchProcess:
             self.searchProcess.destroy()
             self.searchProcess = None
+        if self._flushId:
+            gobject.source_remove(self._flushId)
+            self._flushId = None
+        self._pendingResults = []
+        self._hiddenResults = []
 
         panel = self._window.get_bottom_panel()
         resultContainer = self.tree.get_widget('hbxFileSearchResult')
@@ -0,0 +1,115 @@
+"""
+    Persistent, incrementally refreshed file index
+"""
+
+import os
+import cPickle
+import hashlib
+from util import debug
+
+index_dir = os.path.expanduser("~/.gnome2/gedit/plugins/fuzzyopen/index")
+
+# indexes stay in memory for the lifetime of gedit, keyed by (root, show_hidden)
+_indexes = {}
+
+def get_index( root, show_hidden=False ):
+  key = (root, show_hidden)
+  index = _indexes.get(key)
+  if index is None:
+    index = FileIndex( root, show_hidden )
+    _indexes[key] = index
+  index.refresh()
+  return index
+
+class FileIndex:
+  def __init__( self, root, show_hidden=False ):
+    self._root = root
+    self._show_hidden = show_hidden
+    # relative dir -> (mtime, subdirs, filenames)
+    self._dirs = {}
+    self._files = None
+    self._filtered = None
+    self._filtered_key = None
+    self._path = os.path.join(index_dir, hashlib.md5("%s\0%d" % (root, show_hidden)).hexdigest())
+    self._load()
+
+  def _load( self ):
+    try:
+      f = open(self._path, 'rb')
+      try:
+        root, dirs = cPickle.load(f)
+      finally:
+        f.close()
+    except (IOError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+      return
+    if root == self._root:
+      self._dirs = dirs
+      debug("Loaded index for %s (%d dirs)" % (root, len(dirs)))
+
+  def _save( self ):
+    try:
+      if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+      tmp = self._path + '.tmp'
+      f = open(tmp, 'wb')
+      try:
+        cPickle.dump((self._root, self._dirs), f, cPickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+      os.rename(tmp, self._path)
+    except (IOError, OSError), e:
+      debug("Could not save index: %s" % e)
+
+  # a directory's mtime changes whenever an entry is added, removed or renamed
+  # in it, so only directories with a new mtime need to be listed again
+  def refresh( self ):
+    seen = {}
+    changed = False
+    stack = ['']
+    while stack:
+      rel = stack.pop()
+      full = os.path.join(self._root, rel)
+      try:
+        mtime = os.stat(full).st_mtime
+      except OSError:
+        continue
+      entry = self._dirs.get(rel)
+      if entry is None or entry[0] != mtime:
+        entry = self._scan(full, mtime)
+        changed = True
+      seen[rel] = entry
+      for d in entry[1]:
+        stack.append(os.path.join(rel, d))
+    if changed or len(seen) != len(self._dirs):
+      self._dirs = seen
+      self._files = None
+      self._filtered = None
+      self._save()
+    debug("Index refreshed, changed = %s" % changed)
+
+  def _scan( self, full, mtime ):
+    dirs, files = [], []
+    try:
+      names = os.listdir(full)
+    except OSError:
+      names = []
+    for name in names:
+      if not self._show_hidden and name[0] == '.':
+        continue
+      path = os.path.join(full, name)
+      if os.path.isdir(path):
+        # like os.walk, do not follow symlinked directories
+        if not os.path.islink(path):
+          dirs.append(name)
+      else:
+        files.append(name)
+    return (mtime, dirs, files)
+
+  def files( self, excluded=() ):
+    if self._files is None:
+      self._files = sorted( os.path.join(rel, f) for rel, entry in self._dirs.iteritems() for f in entry[2] )
+    key = tuple(excluded)
+    if self._filtered is None or self._filtered_key != key:
+      self._filtered = [ f for f in self._files if os.path.splitext( f )[-1][1:] not in excluded ]
+      self._filtered_key = key
+    return self._filtered
@@ -9,6 +9,7 @@ from util import debug
 import util
 
 app_string = "Fuzzy open"
+search_delay = 100 # ms after the last keystroke
 
 ui_str="""<ui>
 <menubar name="MenuBar">
@@ -34,10 +35,12 @@ class FuzzyOpenPluginInstance:
     self._git = False
     self._liststore = None
     self._last_pattern = ""
+    self._search_id = None
     self._init_glade()
     self._insert_menu()
 
   def deactivate( self ):
+    self._cancel_search()
     self._remove_menu()
     self._action_group = None
     self._window = None
@@ -106,15 +109,48 @@ class FuzzyOpenPluginInstance:
 
   #keyboard event on entry field
   def on_pattern_entry( self, widget, event ):
-    oldtitle = self._fuzzyopen_window.get_title().replace(" * too many hits", "")
     if event.keyval == gtk.keysyms.Return:
+      self._finish_search()
       self.open_selected_item( event )
       return
     pattern = self._glade_entry_name.get_text()
     if pattern == self._last_pattern:
       return
     self._last_pattern = pattern
-    suggestions = self._suggestion.suggest(pattern)
+    self._cancel_search()
+    self._search_id = gobject.timeout_add(search_delay, self._start_search, pattern)
+
+  #search runs in idle callbacks and is superseded by the next keystroke
+  def _start_search( self, pattern ):
+    self._search_id = gobject.idle_add(self._search_step, self._suggestion.isuggest(pattern))
+    return False
+
+  def _search_step( self, search ):
+    suggestions = search.next()
+    if suggestions is None:
+      return True
+    self._search_id = None
+    self._show_suggestions(suggestions)
+    return False
+
+  #a pending search is run to the end at once, so Return opens a hit of the
+  #pattern as typed and not of the previous one
+  def _finish_search( self ):
+    if self._search_id is None:
+      return
+    self._cancel_search()
+    self._last_pattern = self._glade_entry_name.get_text()
+    for suggestions in self._suggestion.isuggest(self._last_pattern):
+      if suggestions is not None:
+        self._show_suggestions(suggestions)
+
+  def _cancel_search( self ):
+    if self._search_id is not None:
+      gobject.source_remove(self._search_id)
+      self._search_id = None
+
+  def _show_suggestions( self, suggestions ):
+    oldtitle = self._fuzzyopen_window.get_title().replace(" * too many hits", "")
     self._liststore.clear()
     for suggestion in suggestions:
       self._liststore.append(suggestion)
@@ -147,6 +183,7 @@ class FuzzyOpenPluginInstance:
     debug("Rootpath = "+ self._rootpath)
     self._git = self.check_git(self._rootpath)
     debug("Use Git = " + str(self._git))
+    self._cancel_search()
     self._suggestion = FuzzySuggestion( self._rootpath, self._show_hidden, self._git )
     self._fuzzyopen_window.show()
     self._glade_entry_name.select_region(0,-1)
@@ -0,0 +1,123 @@
+"""
+    Fuzzy matching and scoring engine
+"""
+
+import re
+import heapq
+from bisect import bisect_right
+
+class FuzzyMatcher:
+  def __init__( self, fileset, ignore_case=True ):
+    self._fileset = fileset
+    self._ignore_case = ignore_case
+    if ignore_case:
+      self._keys = [ f.lower() for f in fileset ]
+    else:
+      self._keys = fileset
+    # all keys in one string so a full scan runs inside the regex engine,
+    # with the start offset of every key to map matches back to an index
+    self._blob = '\n'.join(self._keys)
+    self._offsets = []
+    offset = 0
+    for key in self._keys:
+      self._offsets.append(offset)
+      offset += len(key) + 1
+
+  def fileset( self ):
+    return self._fileset
+
+  def _key( self, sub ):
+    if self._ignore_case:
+      return sub.lower()
+    return sub
+
+  def _pattern( self, sub ):
+    chars = [ re.escape(c) for c in sub ]
+    return re.compile(chars[0] + ''.join([ '[^%s\n]*%s' % (c, c) for c in chars[1:] ]) + '[^\n]*')
+
+  # indices (in fileset order) of the paths containing sub as a subsequence,
+  # either over the whole fileset or over the given candidate indices
+  def match( self, sub, candidates=None ):
+    result = []
+    for chunk in self.imatch( sub, candidates ):
+      result.extend(chunk)
+    return result
+
+  # same as match, in lists covering at most chunk_size keys each
+  def imatch( self, sub, candidates=None, chunk_size=20000 ):
+    sub = self._key(sub)
+    if candidates is None:
+      total = len(self._keys)
+    else:
+      total = len(candidates)
+    pattern = sub and self._pattern(sub)
+    for start in range(0, total, chunk_size):
+      end = min(start + chunk_size, total)
+      if candidates is not None:
+        chunk = candidates[start:end]
+        if pattern:
+          keys, search = self._keys, pattern.search
+          chunk = [ i for i in chunk if search(keys[i]) ]
+      elif not pattern:
+        chunk = range(start, end)
+      else:
+        # the pattern consumes the rest of the line, so every key matches once
+        offsets = self._offsets
+        endpos = offsets[end] - 1 if end < total else len(self._blob)
+        chunk = [ bisect_right(offsets, m.start()) - 1 for m in pattern.finditer(self._blob, offsets[start], endpos) ]
+      yield chunk
+
+  # the best count matches as (highlight, path, score), best first; markup is
+  # only built for those
+  def top( self, sub, indices, count, git_files=() ):
+    return self.describe( sub, self.best( sub, indices, count, git_files ), git_files )
+
+  # the count best scoring indices, best first; equal scores keep the order of
+  # indices, so a running result can be refined with later chunks
+  def best( self, sub, indices, count, git_files=() ):
+    return heapq.nlargest(count, indices, key=self._scorer(self._key(sub), git_files))
+
+  def describe( self, sub, indices, git_files=() ):
+    sub = self._key(sub)
+    score = self._scorer(sub, git_files)
+    return [ (self._highlight(self._fileset[i], self._positions(sub, i)), self._fileset[i], score(i)) for i in indices ]
+
+  def _positions( self, sub, i ):
+    key, positions, p = self._keys[i], [], -1
+    for c in sub:
+      p = key.find(c, p + 1)
+      positions.append(p)
+    return positions
+
+  # scoring runs for every match, so it is a closure over locals rather than
+  # a chain of method calls
+  def _scorer( self, sub, git_files ):
+    keys, fileset, n = self._keys, self._fileset, len(sub)
+    def score( i ):
+      key = keys[i]
+      length, find = len(key), key.find
+      result, streak, expected, pos, p = 0, 0, 0, 0, -1
+      for c in sub:
+        p = find(c, p + 1)
+        if p == expected:
+          streak += 1
+        else:
+          streak = 1
+        result += streak
+        pos += length - p
+        expected = p + 1
+      if n != 0 and length > 1:
+        result += float(pos-1) / ((float(length)-1.0) * float(n))
+      if git_files and fileset[i][expected:] in git_files:
+        result += 1
+      return float(result)
+    return score
+
+  def _highlight( self, path, positions ):
+    highlight, last = [], 0
+    for p in positions:
+      highlight.append(path[last:p])
+      highlight.append("<b>" + path[p] + "</b>")
+      last = p + 1
+    highlight.append(path[last:])
+    return ''.join(highlight)
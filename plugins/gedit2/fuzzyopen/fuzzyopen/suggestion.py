@@ -4,11 +4,22 @@
 
 import os
 import subprocess
+from collections import OrderedDict
 import gio, gtk
 from util import debug
 import util
+import fileindex
+from matcher import FuzzyMatcher
 
 max_result = 15
+max_cached_patterns = 16
+chunk_size = 20000
+
+# file extension -> icon pixbuf
+_icons = {}
+
+# matchers are reused across dialog openings while the indexed fileset is unchanged
+_matchers = {}
 
 class FuzzySuggestion:
   def __init__( self, filepath, show_hidden=False, git=False ):
@@ -18,23 +29,19 @@ class FuzzySuggestion:
     self._excluded = util.config('ignore_ext').split(',')
     self._ignore_case = util.config('ignore_case')
     self._ignore_space = util.config('ignore_space')
+    self._candidates = OrderedDict()
+    self._mtimes = {}
     if self._git:
       self._load_git()
     self._load_file()
 
   def _load_file( self ):
-    self._fileset = []
-    for dirname, dirnames, filenames in os.walk( self._filepath ):
-      if not self._show_hidden:
-        for d in dirnames[:]:
-          if d[0] == '.':
-            dirnames.remove(d)
-      path = os.path.relpath( dirname, self._filepath )
-      for filename in filenames:
-        if (self._show_hidden or filename[0] != '.'):
-          if os.path.splitext( filename )[-1][1:] not in self._excluded:
-            self._fileset.append( os.path.normpath(os.path.join( path, filename ) ) )
-    self._fileset = sorted( self._fileset )
+    self._fileset = fileindex.get_index( self._filepath, self._show_hidden ).files( self._excluded )
+    key = (self._filepath, self._show_hidden, self._ignore_case)
+    self._matcher = _matchers.get(key)
+    if self._matcher is None or self._matcher.fileset() is not self._fileset:
+      self._matcher = FuzzyMatcher( self._fileset, self._ignore_case )
+      _matchers[key] = self._matcher
     debug("Loaded files count = %d" % len(self._fileset))
 
   def _load_git( self ):
@@ -42,29 +49,67 @@ class FuzzySuggestion:
     debug("Git file path: %s" % self._filepath)
     self._git_with_diff = [ s.strip().split('\t') for s in self._git_with_diff ]
     self._git_files = [ s[2] for s in self._git_with_diff ]
+    self._git_set = set(self._git_files)
+    self._git_diff = dict( (s[2], s) for s in self._git_with_diff )
 
   def suggest( self, sub ):
+    for suggestion in self.isuggest( sub ):
+      pass
+    return suggestion
+
+  # yields None after every chunk of work and the suggestions last, so a
+  # search can be spread over idle callbacks and dropped at any point
+  def isuggest( self, sub ):
     if self._ignore_space:
       sub = sub.replace(' ', '')
-    suggestion = []
-    for f in self._fileset:
-      highlight, score = self._match_score( sub, f )
-      if score >= len(sub):
-        suggestion.append((highlight, f, score))
-    suggestion = sorted(suggestion, key=lambda x: x[2], reverse=True)[:max_result]
+    git_files = self._git and self._git_set or ()
+    candidates = self._candidates.pop(sub, None)
+    if candidates is None:
+      chunks = self._matcher.imatch( sub, self._prefix_candidates( sub ), chunk_size )
+    else:
+      chunks = [ candidates[i:i+chunk_size] for i in range(0, len(candidates), chunk_size) ]
+    matched, best = [], []
+    for chunk in chunks:
+      matched.extend(chunk)
+      best = self._matcher.best( sub, best + chunk, max_result, git_files )
+      yield None
+    if len(self._candidates) >= max_cached_patterns:
+      self._candidates.popitem(last=False)
+    self._candidates[sub] = matched
+    suggestion = self._matcher.describe( sub, best, git_files )
     debug("Suggestion count = %d" % len(suggestion))
-    return [ self._metadata(s) for s in suggestion ]
+    yield [ self._metadata(s) for s in suggestion ]
+
+  # every match for a pattern is a match for its prefixes, so only the
+  # candidates of the longest cached prefix have to be scanned again
+  def _prefix_candidates( self, sub ):
+    for n in range(len(sub) - 1, 0, -1):
+      if sub[:n] in self._candidates:
+        return self._candidates[sub[:n]]
+    return None
 
   def _metadata( self, suggestion ):
     target = os.path.join(self._filepath, suggestion[1])
-    time_string = util.relative_time(os.stat(target).st_mtime)
+    time_string = util.relative_time(self._mtime(target))
     highlight = "<span size='x-large'>" + suggestion[0] + "</span>\n" + self._token_string( suggestion[1] ) + "MODIFY " + time_string
-    if self._git and (suggestion[1] in self._git_files):
-      index = self._git_files.index(suggestion[1])
-      highlight += self._git_string(index)
-    file_icon = gio.File(os.path.join(self._filepath, suggestion[1])).query_info('standard::icon').get_icon()
-    icon = gtk.icon_theme_get_default().lookup_by_gicon(file_icon, 40, gtk.ICON_LOOKUP_USE_BUILTIN)
-    return (icon and icon.load_icon(), highlight, suggestion[1])
+    if self._git and (suggestion[1] in self._git_diff):
+      highlight += self._git_string(self._git_diff[suggestion[1]])
+    return (self._icon(target), highlight, suggestion[1])
+
+  # files are stat'ed once per dialog opening
+  def _mtime( self, target ):
+    mtime = self._mtimes.get(target)
+    if mtime is None:
+      mtime = self._mtimes[target] = os.stat(target).st_mtime
+    return mtime
+
+  def _icon( self, target ):
+    ext = os.path.splitext(target)[-1] or os.path.basename(target)
+    if ext not in _icons:
+      file_icon = gio.File(target).query_info('standard::icon').get_icon()
+      icon = gtk.icon_theme_get_default().lookup_by_gicon(file_icon, 40, gtk.ICON_LOOKUP_USE_BUILTIN)
+      _icons[ext] = icon and icon.load_icon()
+    return _icons[ext]
 
   def _token_string( self, file ):
     token = os.path.splitext(file)[-1]
@@ -74,40 +119,10 @@ class FuzzySuggestion:
       token = '.'
     return "<span variant='smallcaps' foreground='#FFFFFF' background='#B2B2B2'><b> " + token.upper() + ' </b></span> '
 
-  def _git_string( self, line_id ):
-    add = int(self._git_with_diff[line_id][0])
-    delete = int(self._git_with_diff[line_id][1])
+  def _git_string( self, numstat ):
+    add = int(numstat[0])
+    delete = int(numstat[1])
     if add != 0 or delete != 0:
       return "  GIT <tt><span foreground='green'>" + ('+' * add) + "</span><span foreground='red'>" + ('-' * delete) + "</span></tt>"
     else:
       return ""
-
-  def _match_score( self, sub, str ):
-    result, score, pos, git, orig_length, highlight = 0, 0, 0, 0, len(str), ''
-    for c in sub:
-      while str != '' and not self._match(str[0], c):
-        score = 0
-        highlight += str[0]
-        str = str[1:]
-      if str == '':
-        return (highlight, 0)
-      score += 1
-      result += score
-      pos += len(str)
-      highlight += "<b>" + str[0] + "</b>"
-      str = str[1:]
-    highlight += str
-    if len(sub) != 0 and orig_length > 1:
-      pos = float(pos-1) / ((float(orig_length)-1.0) * float(len(sub)))
-    else:
-      pos = 0.0
-    if self._git and (str in self._git_files):
-      git = 1
-    return (highlight, float(result) + pos + git)
-
-  def _match(self, a, b):
-    if self._ignore_case:
-      return a.lower() == b.lower()
-    else:
-      return a == b
-
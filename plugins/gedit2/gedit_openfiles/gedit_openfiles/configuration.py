@@ -6,4 +6,7 @@ class Configuration(sgconf.Options):
     exclude_list = sgconf.ListOption(['*pyc', '*.class', '*.swp', '.svn', '.git', '*.gif', '*.png', '*.jpg', '*.jpeg', '*.ico'])
     static_root_path = sgconf.StringOption('/')
     use_filebrowser = sgconf.BoolOption(True)
+    # Keep the file index across restarts, in a sqlite file per root named
+    # after this path, empty for memory
+    database_path = sgconf.StringOption('')
 
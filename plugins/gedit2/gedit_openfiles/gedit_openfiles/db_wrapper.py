@@ -3,10 +3,18 @@ Provides the DBWrapper Class which currently wraps sqlite in order to provide
 some abstractions an multithreading support.
 """
 import os
+import re
+import hashlib
 import sqlite3
 from logger import log
 from threading import Thread
-from Queue import Queue
+from Queue import Queue, Empty
+
+# Files are inserted in batches of this size, or after FLUSH_INTERVAL seconds
+# without other work
+BATCH_SIZE = 500
+BULK_BATCH_SIZE = 10000
+FLUSH_INTERVAL = 0.5
 
 # Register string handler
 def adapt_str(s):
@@ -14,25 +22,71 @@ def adapt_str(s):
 
 sqlite3.register_adapter(str, adapt_str)
 
+def trigrams(text):
+    """
+    Returns the distinct lower cased trigrams of text as space separated
+    hex tokens, so the FTS tokenizer keeps punctuation like "/" and ".".
+    """
+    text = text.lower()
+    data = text.encode("utf-8")
+    if len(data) == len(text):
+        # ASCII, one hex pair per character
+        data = data.encode("hex")
+        tokens = set([data[i:i + 6] for i in range(0, len(data) - 4, 2)])
+    else:
+        tokens = set([text[i:i + 3].encode("utf-8").encode("hex")
+            for i in range(len(text) - 2)])
+    if not tokens:
+        return ""
+    return "x" + " x".join(tokens)
+
 class DBWrapper(Thread):
     """
     Class to wrap the python sqlite3 module to support multithreading
     """
 
-    def __init__(self):
+    def __init__(self, database=":memory:"):
+        """
+        The files of each root are kept in their own database, a file named
+        after database and the root, or a new one in memory.
+        """
         # Create Database and a queue
         Thread.__init__(self)
         self._queue = Queue()
+        self._database = database
+        self._root = None
+        self._use_trigrams = False
+        self._bulk = False
+        self._pending = []
         self.start()
 
     def run(self):
-        self._create_db()
+        self._create_db(":memory:")
         while True:
             try:
-                sql, params, result = self._queue.get()
+                try:
+                    sql, params, result = self._queue.get(timeout=FLUSH_INTERVAL)
+                except Empty:
+                    self._flush()
+                    continue
+                if sql == '__ADD__':
+                    self._pending.append(params)
+                    if len(self._pending) >= (self._bulk and BULK_BATCH_SIZE or BATCH_SIZE):
+                        self._flush()
+                    continue
+                # Keep statements in order with the files queued before them
+                self._flush()
                 if sql == '__CLOSE__':
                     self._db.close()
                     break
+                if sql == '__BEGIN_BULK__':
+                    self._begin_bulk(params)
+                    continue
+                if sql == '__END_BULK__':
+                    self._end_bulk()
+                    continue
+                if sql == '__SEARCH__':
+                    sql, params = self._search_query(*params)
                 log.info("[DBWrapper] QUERY: %s" % sql)
                 log.info("[DBWrapper] PARAMS: %s" % str(params))
                 log.info("[DBWrapper] RESULT: " + str(result))
@@ -41,12 +95,16 @@ class DBWrapper(Thread):
                     cursor.execute(sql, params)
                 else:
                     cursor.execute(sql)
-            except sqlite3.OperationalError, e:
-                log.error("[DBWrapper] OperationalError : %s" % e)
+                rows = cursor.fetchall()
+            except sqlite3.DatabaseError, e:
+                # A failed statement must not stop the thread, nor leave a
+                # select waiting for its result
+                log.error("[DBWrapper] %s : %s" % (e.__class__.__name__, e))
+                rows = []
 
             if result:
                 log.info("[DBWrapper] Putting Results")
-                for row in cursor.fetchall():
+                for row in rows:
                     result.put(row)
                 result.put("__END__")
 
@@ -68,18 +126,33 @@ class DBWrapper(Thread):
         log.info("[DBWrapper] SELECT RESULT COUNT: " + str(len(list_result)))
         return list_result
 
-    def search(self, input):
+    def search(self, input, root=""):
         log.info("[DBWrapper] select_on_filename method")
-        params = input.replace(" ", "%")+"%"
-        result = self.select("SELECT DISTINCT name, path FROM files " +
-            "WHERE path LIKE ? ORDER BY open_count DESC, path ASC LIMIT 20", (params, ))
-        return result
+        params = (root + "%" + input).replace(" ", "%")+"%"
+        # Every literal part of 3 or more characters narrows the candidates
+        # through the trigram index before the LIKE is checked
+        tokens = " ".join([trigrams(adapt_str(part)) for part in
+            re.split("[ %_]", input) if len(part) >= 3])
+        return self.select("__SEARCH__", (tokens, params))
 
     def add_file(self, path, name):
         path = os.path.join(path, name)
         log.debug("[DBWrapper] Adding File: " + path)
-        self.execute("INSERT INTO files (name, path) VALUES (?, ?)",
-            (name, path))
+        self._queue.put(("__ADD__", (name, path), None))
+
+    def begin_bulk_load(self, root):
+        """
+        Starts crawling root: files are inserted in large batches without
+        updating the trigram index, which is rebuilt in end_bulk_load. The
+        database of root is opened if it holds another root.
+        """
+        self._queue.put(("__BEGIN_BULK__", root, None))
+
+    def end_bulk_load(self):
+        """
+        Finishes a complete crawl, dropping files that were not seen again.
+        """
+        self._queue.put(("__END_BULK__", None, None))
 
     def remove_file(self, path, name):
         path = os.path.join(path, name)
@@ -106,10 +179,96 @@ class DBWrapper(Thread):
         res = self.select("SELECT COUNT(*) FROM files")
         return res[0][0]
 
-    def _create_db(self):
-        self._db = sqlite3.connect(":memory:")
-        self.execute("CREATE TABLE files ( id AUTO_INCREMENT PRIMARY KEY, " +
+    def _search_query(self, tokens, params):
+        # The trigram index is incomplete while crawling
+        if self._use_trigrams and tokens and not self._bulk:
+            return ("SELECT DISTINCT name, path FROM files " +
+                "WHERE rowid IN (SELECT docid FROM files_trigrams " +
+                "WHERE files_trigrams MATCH ?) AND path LIKE ? " +
+                "ORDER BY open_count DESC, path ASC LIMIT 20", (tokens, params))
+        return ("SELECT DISTINCT name, path FROM files " +
+            "WHERE path LIKE ? ORDER BY open_count DESC, path ASC LIMIT 20", (params, ))
+
+    def _flush(self):
+        if not self._pending:
+            return
+        log.info("[DBWrapper] Inserting %d files" % len(self._pending))
+        try:
+            self._db.executemany("INSERT OR IGNORE INTO files (name, path) " +
+                "VALUES (?, ?)", self._pending)
+            if self._bulk:
+                self._db.executemany("INSERT OR IGNORE INTO crawled (path) VALUES (?)",
+                    [(path, ) for name, path in self._pending])
+            self._db.commit()
+        except sqlite3.DatabaseError, e:
+            log.error("[DBWrapper] %s : %s" % (e.__class__.__name__, e))
+        self._pending = []
+
+    def _begin_bulk(self, root):
+        log.info("[DBWrapper] Begin bulk load of %s" % root)
+        self._bulk = True
+        if root != self._root:
+            self._db.close()
+            self._create_db(self._root_database(root))
+            self._root = root
+        if self._use_trigrams:
+            self._db.execute("DROP TRIGGER IF EXISTS files_trigrams_insert")
+        self._db.execute("CREATE TEMP TABLE IF NOT EXISTS crawled " +
+            "(path VARCHAR(255) PRIMARY KEY)")
+        self._db.execute("DELETE FROM crawled")
+        self._db.commit()
+
+    def _end_bulk(self):
+        if not self._bulk:
+            return
+        log.info("[DBWrapper] End bulk load")
+        self._db.execute("DELETE FROM files WHERE path NOT IN " +
+            "(SELECT path FROM crawled)")
+        self._db.execute("DROP TABLE crawled")
+        if self._use_trigrams:
+            # Another window on the same root may add files meanwhile, they
+            # are indexed by the trigger or by the rebuild after it
+            self._create_trigram_triggers()
+            self._db.execute("DELETE FROM files_trigrams")
+            self._db.execute("INSERT INTO files_trigrams (docid, trigrams) " +
+                "SELECT rowid, trigrams(path) FROM files")
+        self._db.commit()
+        self._bulk = False
+
+    def _root_database(self, root):
+        if self._database == ":memory:":
+            return self._database
+        if isinstance(root, unicode):
+            root = root.encode("utf-8")
+        return "%s.%s" % (self._database, hashlib.md5(root).hexdigest())
+
+    def _create_db(self, database):
+        log.info("[DBWrapper] Opening database %s" % database)
+        self._db = sqlite3.connect(database, timeout=30)
+        self._db.create_function("trigrams", 1, trigrams)
+        self._use_trigrams = False
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ( " +
+            "id AUTO_INCREMENT PRIMARY KEY, " +
             "path VARCHAR(255), name VARCHAR(255), " +
             "open_count INTEGER DEFAULT 0)")
+        self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_path ON files (path)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_open_count ON files (open_count)")
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_trigrams " +
+                "USING fts4(trigrams)")
+        except sqlite3.OperationalError, e:
+            log.error("[DBWrapper] No FTS4, searching without index : %s" % e)
+        else:
+            self._create_trigram_triggers()
+            self._use_trigrams = True
+        self._db.commit()
 
-
+    def _create_trigram_triggers(self):
+        # Keep the trigram index in sync with the files table
+        self._db.execute("CREATE TRIGGER IF NOT EXISTS files_trigrams_insert " +
+            "AFTER INSERT ON files " +
+            "BEGIN INSERT INTO files_trigrams (docid, trigrams) " +
+            "VALUES (new.rowid, trigrams(new.path)); END")
+        self._db.execute("CREATE TRIGGER IF NOT EXISTS files_trigrams_delete " +
+            "AFTER DELETE ON files " +
+            "BEGIN DELETE FROM files_trigrams WHERE docid = old.rowid; END")
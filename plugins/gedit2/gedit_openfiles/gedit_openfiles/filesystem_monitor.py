@@ -12,7 +12,7 @@ import re
 import urllib
 from logger import log
 from pyinotify import WatchManager, Notifier, ThreadedNotifier, EventsCodes, ProcessEvent
-from threading import Thread
+from threading import Thread, Lock
 from threadpool import ThreadPool
 
 THREAD_POOL_WORKS = 4
@@ -77,6 +77,12 @@ class FilesystemMonitor(object):
 
         self._thread_pool = ThreadPool(THREAD_POOL_WORKS)
 
+        # Directories of the current crawl still to be walked
+        self._crawl_lock = Lock()
+        self._crawl_generation = 0
+        self._crawl_pending = 0
+        self._crawling = False
+
         # Add a watch to the root of the dir
         self.watch_manager = WatchManager()
         self.notifier = ThreadedNotifier(self.watch_manager, FileProcessEvent(self))
@@ -105,8 +111,18 @@ class FilesystemMonitor(object):
         if wd:
           self.watch_manager.rm_watch(wd, rec=True)
 
-        self.searcher.clear_database()
+        self._crawl_lock.acquire()
+        try:
+            self._crawl_generation += 1
+            self._crawl_pending = 0
+            self._crawling = True
+            generation = self._crawl_generation
+        finally:
+            self._crawl_lock.release()
+
+        self.searcher.begin_bulk_load()
         self.add_directory(self.searcher.current_root)
+        self._finish_crawl_task(generation, 0)
 
     def add_directory(self, path):
         """
@@ -115,7 +131,37 @@ class FilesystemMonitor(object):
         basename = os.path.basename(path)
         if self.validate(basename):
             self.watch_manager.add_watch(path, EVENT_MASK)
-            self._thread_pool.queueTask(self.walk_directory, path)
+            self._crawl_lock.acquire()
+            try:
+                self._crawl_pending += 1
+                generation = self._crawl_generation
+            finally:
+                self._crawl_lock.release()
+            self._thread_pool.queueTask(self._walk_task, (path, generation))
+
+    def _walk_task(self, args):
+        path, generation = args
+        try:
+            self.walk_directory(path)
+        finally:
+            self._finish_crawl_task(generation, 1)
+
+    def _finish_crawl_task(self, generation, done):
+        """
+        Ends the bulk load once every directory of the current crawl has been
+        walked.
+        """
+        self._crawl_lock.acquire()
+        try:
+            if generation != self._crawl_generation:
+                return
+            self._crawl_pending -= done
+            if not self._crawling or self._crawl_pending > 0:
+                return
+            self._crawling = False
+        finally:
+            self._crawl_lock.release()
+        self.searcher.end_bulk_load()
 
     def add_file(self, path, name):
         """
@@ -25,7 +25,7 @@ class FilesystemSearcher(object):
         self._plugin = plugin
         self._message_bus = self._window.get_message_bus()
 
-        self._db = DBWrapper()
+        self._db = DBWrapper(self.configuration.database_path or ":memory:")
         self._monitor = None
 
         self._message_bus.connect('/plugins/filebrowser', 'root_changed', self.root_changed)
@@ -80,13 +80,18 @@ class FilesystemSearcher(object):
     def clear_database(self):
         self._db.clear_database()
 
+    def begin_bulk_load(self):
+        self._db.begin_bulk_load(self.current_root)
+
+    def end_bulk_load(self):
+        self._db.end_bulk_load()
+
     def build_exclude_list(self):
         self._monitor._build_exclude_list()
 
     def search(self, input):
-        query = self.current_root + "%" + input
         filewrappers = []
-        for row in self._db.search(query):
+        for row in self._db.search(input, self.current_root):
             # FIXME: Set data in variables so you can tell what data is returned.
             filewrappers.append(FileWrapper(input, self.current_root, row[0], row[1]))
         return filewrappers
@@ -1,7 +1,9 @@
 import gtk
 import gconf
 import gedit
+import gobject
 import copy
+from bisect import bisect_right
 
 version = "0.1"
 
@@ -45,6 +47,100 @@ def colorstr_from_gdkcolor(c):
   s = c.to_string()
   return '#'+s[1:3]+s[5:7]+s[9:11]
   
+class LineRanges:
+  """the edited lines, as sorted, disjoint [start,end) ranges of line numbers
+  
+  The ranges from index M.moved on are stored M.shift lines off, so inserting
+  or joining lines only moves the ranges between the previous edit and this
+  one, instead of all the ranges after it."""
+  def __init__(M):
+    M.clear()
+    
+  def clear(M):
+    M.starts = []
+    M.ends   = []
+    M.moved  = 0
+    M.shift  = 0
+    
+  def move(M, i):
+    "store the ranges before index i unshifted"
+    starts, ends, d = M.starts, M.ends, M.shift
+    if i > M.moved:
+      starts[M.moved:i] = [s+d for s in starts[M.moved:i]]
+      ends[M.moved:i]   = [e+d for e in ends[M.moved:i]]
+    elif i < M.moved:
+      starts[i:M.moved] = [s-d for s in starts[i:M.moved]]
+      ends[i:M.moved]   = [e-d for e in ends[i:M.moved]]
+    M.moved = i
+    
+  def find(M, values, line):
+    "the index of the first range whose start or end (values) is after line"
+    i = bisect_right(values, line, 0, M.moved)
+    if i == M.moved:
+      i = bisect_right(values, line-M.shift, M.moved)
+    return i
+    
+  def replace(M, i, j, ranges):
+    "replace the ranges [i,j), all before index M.moved, with ranges"
+    M.starts[i:j] = [s for s, e in ranges]
+    M.ends[i:j]   = [e for s, e in ranges]
+    M.moved = i+len(ranges)
+    
+  def add(M, start, end):
+    # merge the ranges overlapping or touching [start,end)
+    i = M.find(M.ends, start-1)
+    j = M.find(M.starts, end)
+    M.move(j)
+    if i < j:
+      start, end = min(M.starts[i], start), max(M.ends[j-1], end)
+    M.replace(i, j, [(start, end)])
+    
+  def insert_lines(M, line, n):
+    "line was split into n+1 lines"
+    if n == 0:
+      return
+    i = M.find(M.ends, line)
+    j = M.find(M.starts, line)
+    M.move(j)
+    # a range with line in it grows, the ones after it move
+    M.replace(i, j, [(s, e+n) for s, e in zip(M.starts[i:j], M.ends[i:j])])
+    M.shift += n
+    
+  def join_lines(M, first, last):
+    "the lines first..last were joined into line first"
+    n = last-first
+    if n == 0:
+      return
+    i = M.find(M.ends, first)
+    j = M.find(M.starts, last+1)
+    M.move(j)
+    ranges = []
+    for s, e in zip(M.starts[i:j], M.ends[i:j]):
+      # what is left of the range before and after the removed lines
+      if s <= first:
+        ranges.append((s, min(e, first+1)))
+      if e > last+1:
+        ranges.append((max(s, last+1)-n, e-n))
+    merged = []
+    for s, e in ranges:
+      if merged and merged[-1][1] >= s:
+        merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+      else:
+        merged.append((s, e))
+    M.replace(i, j, merged)
+    M.shift -= n
+        
+  def lines_between(M, first, last):
+    "the edited lines from first to last"
+    for i in xrange(M.find(M.ends, first), len(M.starts)):
+      s, e = M.starts[i], M.ends[i]
+      if i >= M.moved:
+        s, e = s+M.shift, e+M.shift
+      if s > last:
+        break
+      for line in xrange(max(s, first), min(e, last+1)):
+        yield line
+    
 class PreferencesDialog(gtk.Dialog):
 
   def __init__(M, window):
@@ -142,7 +238,11 @@ class WinAttachedObject:
   def __init__(M, win):
     M.win            = win
     M.connected_docs = []
+    M.edited         = {} # id(doc) -> LineRanges
+    M.adjustments    = [] # (adjustment, handler id, view) of the connected views
+    M.render_ids     = {} # id(doc) -> idle source of a pending render
     M.win.connect("tab-added",M.on_win_tab_added)
+    M.win.connect("tab-removed",M.on_win_tab_removed)
     
   def getdoc(M):
     tab = M.win.get_active_tab()
@@ -164,51 +264,120 @@ class WinAttachedObject:
     if PREFS['highlight']:
       map = view.get_colormap()
       view.set_mark_category_background('EDITED',map.alloc_color(PREFS['highlight_bg_color']))
+  def on_win_tab_removed(M, win, tab):
+    # forget the view, and its document unless another view still shows it
+    view = tab.get_view()
+    for entry in [entry for entry in M.adjustments if entry[2] == view]:
+      entry[0].disconnect(entry[1])
+      M.adjustments.remove(entry)
+    doc = tab.get_document()
+    for other in win.get_views():
+      if other != view and other.get_buffer() == doc:
+        return
+    M.forget_doc(doc)
+    
+  def forget_doc(M, doc):
+    if id(doc) in M.connected_docs:
+      doc.disconnect_by_func(M.on_doc_loaded)
+      doc.disconnect_by_func(M.on_doc_insert_text)
+      doc.disconnect_by_func(M.on_doc_delete_range)
+      M.connected_docs.remove(id(doc))
+    M.edited.pop(id(doc), None)
+    source_id = M.render_ids.pop(id(doc), None)
+    if source_id is not None:
+      gobject.source_remove(source_id)
+    
   def on_doc_loaded(M, doc, unused):
-    # the initial insertion of the entire text left a spurious mark
+    # the initial insertion of the entire text left spurious marks
+    M.edited[id(doc)].clear()
     doc.remove_source_marks(doc.get_start_iter(),doc.get_end_iter())
 
+  # Edits only update the edited line ranges. The source marks showing them
+  # are only created for the lines on screen, once the edits are done.
   def on_doc_insert_text(M, doc, loc, text, N):
-    N        = text.count('\n') + 1
-    nextchar = loc.get_char()
-    itr      = loc.copy()
-    if text[0]=='\n' and nextchar=='\n':
+    L        = loc.get_line()
+    N        = text.count('\n')
+    edited   = M.edited[id(doc)]
+    edited.insert_lines(L, N)
+    if text[0]=='\n' and loc.get_char()=='\n':
       # we inserted a \n at end of line, leave that line alone
-      N -= 1
-    for i in range(N):
-      doc.create_source_mark(None,'EDITED',itr)
-      itr.backward_line()
+      edited.add(L+1, L+N+1)
+    else:
+      edited.add(L, L+N+1)
+    M.queue_render(doc)
       
   def on_doc_delete_range(M, doc, start, end):
+    edited = M.edited[id(doc)]
+    edited.join_lines(start.get_line(), end.get_line())
     if not start.ends_line():
-      doc.create_source_mark(None,'EDITED',start)
-    else:
-      doc.remove_source_marks(start, end, 'EDITED')
+      edited.add(start.get_line(), start.get_line()+1)
+    M.queue_render(doc)
+    
+  def on_adjustment_value_changed(M, adjustment, view):
+    M.queue_render(view.get_buffer())
+    
+  def queue_render(M, doc):
+    if id(doc) not in M.render_ids:
+      M.render_ids[id(doc)] = gobject.idle_add(M.render, doc)
+    
+  def render(M, doc):
+    del M.render_ids[id(doc)]
+    edited = M.edited.get(id(doc))
+    if edited is None:
+      return False
+    for view in M.win.get_views():
+      if view.get_buffer() != doc:
+        continue
+      rect  = view.get_visible_rect()
+      first = view.get_line_at_y(rect.y)[0].get_line()
+      last  = view.get_line_at_y(rect.y+rect.height)[0].get_line()
+      end   = doc.get_iter_at_line(last)
+      end.forward_to_line_end()
+      doc.remove_source_marks(doc.get_iter_at_line(first), end, 'EDITED')
+      for line in edited.lines_between(first, last):
+        doc.create_source_mark(None,'EDITED',doc.get_iter_at_line(line))
+    return False
 
   def update_ui(M):
     doc = M.getdoc()
     if not doc:
       return
+    
+    view = M.getview()
+    scrolled = view and view.get_parent()
+    if isinstance(scrolled, gtk.ScrolledWindow):
+      adjustment = scrolled.get_vadjustment()
+      if adjustment not in [entry[0] for entry in M.adjustments]:
+        hid = adjustment.connect("value-changed", M.on_adjustment_value_changed, view)
+        M.adjustments.append((adjustment, hid, view))
+    
     if id(doc) in M.connected_docs:
       return
     
     # insert id() so that the doc is not kept alive by this list
     M.connected_docs.append(id(doc)) 
+    M.edited[id(doc)] = LineRanges()
     
     doc.connect("loaded", M.on_doc_loaded)
-    doc.connect_after("insert-text", M.on_doc_insert_text)
+    # before the default handlers, the iters still point into the old text
+    doc.connect("insert-text", M.on_doc_insert_text)
     doc.connect("delete-range", M.on_doc_delete_range)
     
   def deactivate(M):
     #print 'deactivate called'
     # ?? turn off EDITED line mark
     M.win.disconnect_by_func(M.on_win_tab_added)
+    M.win.disconnect_by_func(M.on_win_tab_removed)
     for doc in M.win.get_documents():
-      if id(doc) in M.connected_docs:
-        doc.disconnect_by_func(M.on_doc_loaded)
-        doc.disconnect_by_func(M.on_doc_insert_text)
-      doc.disconnect_by_func(M.on_doc_delete_range)
+      M.forget_doc(doc)
     M.connected_docs = []
+    M.edited = {}
+    for adjustment, hid, view in M.adjustments:
+      adjustment.disconnect(hid)
+    M.adjustments = []
+    for source_id in M.render_ids.values():
+      gobject.source_remove(source_id)
+    M.render_ids = {}
     
 
 class HighlightEditedLinesPlugin(gedit.Plugin):
@@ -2,8 +2,10 @@ import gedit
 from gettext import gettext as _
 import gtk
 import gtk.glade
+import gobject
 import os
 import re
+import time
 
 ui_str = """
 <ui>
@@ -19,12 +21,80 @@ ui_str = """
 
 GLADE_FILE = os.path.join(os.path.dirname(__file__), "regexsearch.glade")
 
+###
+# Replaces all matches of a regex in a document.
+#
+# The matches are found once, then only the spans that change are replaced,
+# from the end of the document backwards so the offsets of the remaining
+# matches stay valid. The replacements run in batches from the main loop,
+# all inside one user action, and can be cancelled between batches.
+class ReplaceAllJob:
+    # seconds of replacing before control returns to the main loop
+    BATCH_TIME = 0.05
+
+    def __init__(self, document, regex, replace_string, use_backreferences, on_progress, on_finished):
+        self._document = document
+        self._on_progress = on_progress
+        self._on_finished = on_finished
+        self._cancelled = False
+
+        text = unicode(document.get_text(document.get_start_iter(), document.get_end_iter(), False), "utf-8")
+        self.n_matches = 0
+        self._spans = []
+        last_end = -1
+        for result in regex.finditer(text):
+            # like re.sub, skip an empty match right after the previous match
+            if result.start() == result.end() == last_end:
+                continue
+            last_end = result.end()
+            self.n_matches += 1
+            if use_backreferences:
+                replace_text = result.expand(replace_string)
+            else:
+                replace_text = replace_string
+            if replace_text != result.group():
+                self._spans.append((result.start(), result.end(), replace_text))
+        self.n_spans = len(self._spans)
+        self.n_replaced = 0
+
+        document.begin_user_action()
+        self._source_id = gobject.idle_add(self._replace_batch)
+
+    def cancel(self):
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _replace_batch(self):
+        document = self._document
+        spans = self._spans
+        deadline = time.time() + self.BATCH_TIME
+        while spans and not self._cancelled:
+            start, end, replace_text = spans.pop()
+            document.delete(document.get_iter_at_offset(start), document.get_iter_at_offset(end))
+            document.insert(document.get_iter_at_offset(start), replace_text)
+            self.n_replaced += 1
+            if time.time() > deadline:
+                break
+
+        if spans and not self._cancelled:
+            self._on_progress(self)
+            return True
+
+        self._source_id = None
+        document.end_user_action()
+        self._on_finished(self)
+        return False
+
 class RegexSearchInstance:
 
     ###
     # Object initialization
     def __init__(self, window):
         self._window = window
+        self._replace_all_job = None
+        self._read_only_views = []
         self.create_menu_item()
         self.load_dialog()
 
@@ -76,6 +146,7 @@ class RegexSearchInstance:
         self._wrap_around_check = glade_xml.get_widget("wrap_around_check")
         self._use_backreferences_check = glade_xml.get_widget("use_backreferences_check")
         self._case_sensitive_check = glade_xml.get_widget("case_sensitive_check")
+        self._replace_progress = glade_xml.get_widget("replace_progress")
 
 
     ###
@@ -88,29 +159,56 @@ class RegexSearchInstance:
     def on_replace_button_clicked(self, replace_button):
         self.search_document(button = 'replace')
 
-    # Called when the "Replace All" button is clicked.
+    # While a replace all runs, the button stops it.
     def on_replace_all_button_clicked(self, replace_button):
+        if self._replace_all_job is not None:
+            self._replace_all_job.cancel()
+            return
+
         document = self._window.get_active_document()
-        start_iter = document.get_start_iter()
-        end_iter = document.get_end_iter()
-        alltext = unicode(document.get_text(start_iter, end_iter, False), "utf-8")
 
         regex = self.create_regex()
         if regex==None: return
 
-        replace_string = self._replace_text_box.get_text()
-        if not self._use_backreferences_check.get_active():
-            replace_string = replace_string.replace('\\','\\\\') # turn \ into \\ so that backreferences are not done.
+        replace_string = unicode(self._replace_text_box.get_text(), "utf-8")
+        use_backreferences = self._use_backreferences_check.get_active()
 
-        new_string, n_replacements = regex.subn(replace_string, alltext)
+        # the matches' offsets must not move under the job
+        self._read_only_views = [view for view in self._window.get_views() if view.get_buffer() == document and view.get_editable()]
+        for view in self._read_only_views:
+            view.set_editable(False)
 
-        selection_bound_mark = document.get_mark("selection_bound")
-        document.place_cursor(start_iter)
-        document.move_mark(selection_bound_mark, end_iter)
-        document.delete_selection(False, False)
-        document.insert_at_cursor(new_string)
+        self._replace_all_job = ReplaceAllJob(document, regex, replace_string, use_backreferences,
+                                              self.on_replace_all_progress, self.on_replace_all_finished)
+        self._replace_all_button.set_label(_("Stop"))
+        self._find_button.set_sensitive(False)
+        self._replace_button.set_sensitive(False)
+        self._replace_progress.set_fraction(0.0)
+        self._replace_progress.set_text("")
+        self._replace_progress.show()
 
-        self.show_alert_dialog(u"%d replacement(s)." % (n_replacements))
+    ###
+    # Called between the batches of a replace all.
+    def on_replace_all_progress(self, job):
+        self._replace_progress.set_fraction(float(job.n_replaced) / job.n_spans)
+        self._replace_progress.set_text(u"%d / %d" % (job.n_replaced, job.n_spans))
+
+    ###
+    # Called when a replace all is done or has been stopped.
+    def on_replace_all_finished(self, job):
+        self._replace_all_job = None
+        for view in self._read_only_views:
+            view.set_editable(True)
+        self._read_only_views = []
+        self._replace_all_button.set_label(_("Replace All"))
+        self._replace_button.set_sensitive(self.enable_replace)
+        self.on_search_text_changed(self._search_text_box)
+        self._replace_progress.hide()
+
+        if job.cancelled():
+            self.show_alert_dialog(u"Stopped after %d of %d replacement(s)." % (job.n_replaced, job.n_spans))
+        else:
+            self.show_alert_dialog(u"%d replacement(s)." % (job.n_matches))
 
     ###
 #    # Called when the "Close" button is clicked.
@@ -135,17 +233,16 @@ class RegexSearchInstance:
         search_text  = search_text_entry.get_text()
         replace_text_entry = self._replace_text_box
 
-        if len(search_text) > 0:
-            self._find_button.set_sensitive(True)
-        else:
-            self._find_button.set_sensitive(False)
+        # the button stays off while a replace all runs
+        if self._replace_all_job is None:
+            self._find_button.set_sensitive(len(search_text) > 0)
 
         self.on_replace_text_changed(replace_text_entry)
 
     ###
     # Called when the text to be replaced is changed.
     def on_replace_text_changed(self, replace_text_entry):
-        if not self.enable_replace:
+        if not self.enable_replace and self._replace_all_job is None:
             replace_text = replace_text_entry.get_text()
             search_text  =  self._search_text_box.get_text()
 
@@ -172,6 +269,10 @@ class RegexSearchInstance:
     #
     # The search begins from the current cursor position.
     def search_document(self, start_iter = None, wrapped_around = False, button = 'search'):
+        # a replace all runs on the document
+        if self._replace_all_job is not None:
+            return
+
         document = self._window.get_active_document()
 
         if start_iter is None:
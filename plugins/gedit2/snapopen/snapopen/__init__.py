@@ -3,11 +3,19 @@ import gconf
 import pygtk
 pygtk.require('2.0')
 import os, os.path, gobject
+import stat
 from urllib import pathname2url
-import tempfile
+import re
 
 max_result = 50
 app_string = "Snap open"
+search_delay = 100 # ms after the last keystroke
+search_chunk = 5000 # paths matched per idle callback
+refresh_chunk = 200 # directories checked per idle callback
+
+#modify lines below as needed, these defaults work pretty well
+ignored_ext = ('.jpg', '.jpeg', '.gif', '.png', '.psd', '.tif', '.pyc')
+ignored_paths = ('.svn', '.git')
 
 ui_str="""<ui>
 <menubar name="MenuBar">
@@ -20,6 +28,79 @@ ui_str="""<ui>
 </ui>
 """
 
+# file lists stay in memory across dialog openings, keyed by root directory
+_filelists = {}
+
+def get_filelist( root ):
+	if root not in _filelists:
+		_filelists[root] = FileList( root )
+	return _filelists[root]
+
+class FileList:
+	def __init__( self, root ):
+		self.root = root
+		self.files = []
+		self.refreshing = False
+		# relative dir -> (mtime, subdirs, filenames)
+		self._dirs = {}
+
+	# generator, yields None every refresh_chunk directories and finally
+	# whether the list changed; only directories with a new mtime are listed
+	# again
+	def refresh( self ):
+		self.refreshing = True
+		seen = {}
+		changed = False
+		stack = ['']
+		while stack:
+			rel = stack.pop()
+			full = os.path.join(self.root, rel)
+			try:
+				mtime = os.stat(full).st_mtime
+			except OSError:
+				continue
+			entry = self._dirs.get(rel)
+			if entry is None or entry[0] != mtime:
+				entry = self._scan(full, mtime)
+				changed = True
+			seen[rel] = entry
+			for d in entry[1]:
+				stack.append(os.path.join(rel, d))
+			if len(seen) % refresh_chunk == 0:
+				yield None
+		if changed or len(seen) != len(self._dirs):
+			self._dirs = seen
+			self.files = sorted([ os.path.join(rel, f) for rel, entry in seen.iteritems() for f in entry[2] ])
+			changed = True
+		self.refreshing = False
+		yield changed
+
+	def _scan( self, full, mtime ):
+		dirs, files = [], []
+		try:
+			names = os.listdir(full)
+		except OSError:
+			names = []
+		for name in names:
+			if self._ignored(name):
+				continue
+			# like find -type f, symlinks are neither listed nor followed
+			try:
+				mode = os.lstat(os.path.join(full, name)).st_mode
+			except OSError:
+				continue
+			if stat.S_ISDIR(mode):
+				dirs.append(name)
+			elif stat.S_ISREG(mode) and not name.lower().endswith(ignored_ext):
+				files.append(name)
+		return (mtime, dirs, files)
+
+	def _ignored( self, name ):
+		for ignored in ignored_paths:
+			if ignored in name:
+				return True
+		return False
+
 # essential interface
 class SnapOpenPluginInstance:
 	def __init__( self, plugin, window ):
@@ -27,19 +108,22 @@ class SnapOpenPluginInstance:
 		self._plugin = plugin
 		self._encoding = gedit.encoding_get_current()
 		self._rootdir = "file://" + os.getcwd()
-		self._tmpfile = os.path.join(tempfile.gettempdir(), 'snapopen.%s.%s' % (os.getuid(),os.getpid()))
+		self._filelist = None
 		self._show_hidden = False
 		self._liststore = None;
+		self._search_id = None
+		self._refresh_id = None
 		self._init_glade()
 		self._insert_menu()
 
 	def deactivate( self ):
+		self._cancel_search()
+		self._cancel_refresh()
 		self._remove_menu()
 		self._action_group = None
 		self._window = None
 		self._plugin = None
 		self._liststore = None;
-		os.popen('rm %s &> /dev/null' % (self._tmpfile))
 
 	def update_ui( self ):
 		return
@@ -104,34 +188,49 @@ class SnapOpenPluginInstance:
 
 	#keyboard event on entry field
 	def on_pattern_entry( self, widget, event ):
-		oldtitle = self._snapopen_window.get_title().replace(" * too many hits", "")
 		if event.keyval == gtk.keysyms.Return:
 			self.open_selected_item( event )
 			return
-		pattern = self._glade_entry_name.get_text()
-		pattern = pattern.replace(" ",".*")
-		cmd = ""
-		if self._show_hidden:
-			filefilter = ""
-		if len(pattern) > 0:
-			# To search by name
-			cmd = "grep -m %d -e '%s' %s 2> /dev/null" % (max_result, pattern, self._tmpfile)
-			self._snapopen_window.set_title("Searching ... ")
-		else:
-			self._snapopen_window.set_title("Enter pattern ... ")
-		#print cmd
-
+		self._cancel_search()
+		self._search_id = gobject.timeout_add(search_delay, self._start_search, self._glade_entry_name.get_text())
+
+	#the in-memory file list is matched in idle callbacks, a newer keystroke
+	#drops the running search; the pattern is plain text where a space
+	#matches anything
+	def _start_search( self, pattern ):
+		self._search_id = None
+		oldtitle = self._snapopen_window.get_title().replace(" * too many hits", "")
 		self._liststore.clear()
-		maxcount = 0
-		hits = os.popen(cmd).readlines()
-		for file in hits:
-			file = file.rstrip().replace("./", "") #remove cwd prefix
+		if len(pattern) == 0:
+			self._snapopen_window.set_title("Enter pattern ... ")
+			return False
+		regex = re.compile(".*".join([ re.escape(part) for part in pattern.split(" ") ]))
+		# To search by name
+		self._snapopen_window.set_title("Searching ... ")
+		self._search_id = gobject.idle_add(self._search_step, self._search(regex), [oldtitle, 0])
+		return False
+
+	def _search( self, regex ):
+		files = self._filelist.files
+		search = regex.search
+		for start in xrange(0, len(files), search_chunk):
+			yield [ f for f in files[start:start + search_chunk] if search(f) ]
+
+	def _search_step( self, search, state ):
+		hits = next(search, None)
+		for file in hits or []:
+			if state[1] >= max_result:
+				state[1] = state[1] + 1
+				hits = None
+				break
 			name = os.path.basename(file)
 			self._liststore.append([name, file])
-			if maxcount > max_result:
-				break
-			maxcount = maxcount + 1
-		if maxcount > max_result:
+			state[1] = state[1] + 1
+		if hits is not None:
+			return True
+		self._search_id = None
+		oldtitle = state[0]
+		if state[1] > max_result:
 			oldtitle = oldtitle + " * too many hits"
 		self._snapopen_window.set_title(oldtitle)
 
@@ -142,9 +241,35 @@ class SnapOpenPluginInstance:
 			iter = self._liststore.get_iter_first()
 			if iter != None:
 				self._hit_list.get_selection().select_iter(iter)
+		return False
+
+	def _cancel_search( self ):
+		if self._search_id is not None:
+			gobject.source_remove(self._search_id)
+			self._search_id = None
+
+	#the file list is brought up to date in the background, searching uses
+	#the previous list until then
+	def _refresh_step( self, refresh ):
+		changed = refresh.next()
+		if changed is None:
+			return True
+		self._refresh_id = None
+		pattern = self._glade_entry_name.get_text()
+		if changed and len(pattern) > 0:
+			self._cancel_search()
+			self._start_search(pattern)
+		return False
+
+	def _cancel_refresh( self ):
+		if self._refresh_id is not None:
+			gobject.source_remove(self._refresh_id)
+			self._refresh_id = None
+			self._filelist.refreshing = False
 
 	#on menuitem activation (incl. shortcut)
 	def on_snapopen_action( self ):
+		self._cancel_search()
 		self._init_glade()
 
 		fbroot = self.get_filebrowser_root()
@@ -159,11 +284,11 @@ class SnapOpenPluginInstance:
 			else:
 				self._snapopen_window.set_title(app_string + " (Working dir): " + self._rootdir)
 
-		# cache the file list in the background
-		#modify lines below as needed, these defaults work pretty well
-		imagefilter = " ! -iname '*.jpg' ! -iname '*.jpeg' ! -iname '*.gif' ! -iname '*.png' ! -iname '*.psd' ! -iname '*.tif' ! -iname '*.pyc' "
-		dirfilter = " ! -path '*.svn*' ! -path '*.git*' "
-		os.popen("cd %s; find . -type f %s > %s 2> /dev/null &" % (self._rootdir.replace("file://", ""), imagefilter + dirfilter, self._tmpfile))
+		# refresh the cached file list in the background
+		self._cancel_refresh()
+		self._filelist = get_filelist(self._rootdir.replace("file://", ""))
+		if not self._filelist.refreshing:
+			self._refresh_id = gobject.idle_add(self._refresh_step, self._filelist.refresh())
 
 		self._snapopen_window.show()
 		self._glade_entry_name.select_region(0,-1)
@@ -24,6 +24,7 @@ import cairo
 import re
 import copy
 import platform
+from bisect import bisect_left
 
 version = "0.2 beta"
 
@@ -56,7 +57,7 @@ SubsectionREs = (
 
 # ------------------------------------------------------------------------------
 
-class struct:pass
+class struct(object):pass
 
 class TimeRec:
   def __init__(M):
@@ -130,34 +131,34 @@ def match_RE_list(str, REs):
       return m.groups()[0]
   return None
 
+def make_line(i, raw):
+  x = struct()
+  x.i = i
+  x.len = len(raw)
+  x.indent = indent(raw)
+  x.raw = raw
+  x.section = match_RE_list(x.raw,SectionREs)
+  x.subsection = None
+  x.search_match = False
+  if not x.section:
+    x.subsection = match_RE_list(x.raw,SubsectionREs)
+  if x.section or x.subsection:
+    match = Split_Off_Indent_Pattern.match(x.raw)
+    x.indentSTR = None
+    x.justextSTR = None
+    if match:
+      groups = match.groups()
+      if len(groups) == 2:
+        x.indentSTR, x.justextSTR = groups
+  return x
+
 def document_lines(document):
   if not document:
     return None
   #print 'document_lines',document
   STR = document.get_property('text')
   lines = STR.split('\n')
-  ans = []
-  for i,each in enumerate(lines):
-    x = struct()
-    x.i = i
-    x.len = len(each)
-    x.indent = indent(each)
-    x.raw = each
-    x.section = match_RE_list(x.raw,SectionREs)
-    x.subsection = None
-    x.search_match = False
-    if not x.section:
-      x.subsection = match_RE_list(x.raw,SubsectionREs)
-    if x.section or x.subsection:
-      match = Split_Off_Indent_Pattern.match(x.raw)
-      x.indentSTR = None
-      x.justextSTR = None
-      if match:
-        groups = match.groups()
-        if len(groups) == 2:
-          x.indentSTR, x.justextSTR = groups
-    ans.append(x)
-  return ans
+  return [make_line(i,each) for i,each in enumerate(lines)]
   
 def lines_add_section_len(lines):
   line_prevsection = None
@@ -191,6 +192,12 @@ def lines_mark_changed_sections(lines):
         subsec.subsectionchanged = True
   return lines
   
+# half the height of the band redrawn around a changed line of the map
+BAND = 20
+
+# how many changed lines next to an edit are matched again with it
+UNSETTLED_MAX = 100
+
 BUG_MASK = 0
 
 BUG_CAIRO_MAC_FONT_REF  = 1
@@ -311,35 +318,57 @@ def downsample_lines(lines, h, min_scale, max_scale):
       break
       
   if n <= maxlines_:
+    for i, line in enumerate(lines):
+      line.i = i
     downsampled = False
     return lines, scale, downsampled
     
-  # need to downsample
-  lines[0].score = sys.maxint # keep the first line
-  for i in range(1, len(lines)):
-    if lines[i].section:  # keep sections
-      lines[i].score = sys.maxint
-    elif lines[i].subsection:
-      lines[i].score = sys.maxint/2
-    elif lines[i].changed or lines[i].search_match:
-      lines[i].score = sys.maxint/2
+  # need to downsample: the lines are split into as many consecutive buckets
+  # as fit on the map, and the most interesting line of each bucket is kept
+  m = int(maxlines_)
+  kept = []
+  best = None
+  best_score = -1
+  bucket = 0
+  for i, line in enumerate(lines):
+    line.i = i
+    b = i*m//n
+    if b != bucket:
+      kept.append(best)
+      bucket = b
+      best = None
+      best_score = -1
+    if i == 0: # keep the first line
+      score = 3
+    elif line.section:  # keep sections
+      score = 2
+    elif line.subsection or line.changed or line.search_match:
+      score = 1
     else:
-      if 0: # get rid of lines that are very different
-        lines[i].score = abs(lines[i].indent-lines[i-1].indent) \
-                         + abs(len(lines[i].raw)-len(lines[i-1].raw))
-      if 1: # get rid of lines randomly
-        lines[i].score = hash(lines[i].raw)
-        if lines[i].score > sys.maxint/2:
-          lines[i].score -= sys.maxint/2
-                     
-  scoresorted = sorted(lines, lambda x,y: cmp(x.score,y.score))
-  erasures_ = int(math.ceil(n - maxlines_))
-  #print 'erasures_',erasures_
-  scoresorted[0:erasures_]=[]
+      score = 0
+    if score > best_score: # the first line of the bucket wins a tie
+      best = line
+      best_score = score
+  kept.append(best)
     
   downsampled = True
   
-  return sorted(scoresorted, lambda x,y:cmp(x.i,y.i)), scale, downsampled
+  return kept, scale, downsampled
+      
+def lines_add_y(lines, h, scale, smooshed, cr):
+  "set line.y, where each line is drawn on the map"
+  lineH = h/len(lines)
+  cr.set_font_size(scale)
+  sofarH = 0
+  for line in lines:
+    line.y = sofarH
+    if smooshed:
+      sofarH += lineH
+    elif line.raw.strip(): # there is some text here
+      sofarH += text_extents(line.raw,cr)[1]
+    else: # empty line
+      sofarH += scale-1
+  return lines
       
 def visible_lines_top_bottom(geditwin):
   view = geditwin.get_active_view()
@@ -578,57 +607,222 @@ def str2rgb(s):
   b = int(s[5:7],16)/256.
   return r,g,b
   
-def init_original_lines_info(doc,lines):
-  rn = []
-  # now we insert marks at the end of every line
-  iter = doc.get_start_iter()
-  n = 0
-  while 1:
-    if n>=len(lines):
-      break
-    more_left = iter.forward_line()
-    rec = struct()
-    lines[n].mark = doc.create_mark(None,iter,False) 
-    n+=1
-    if not more_left:
-      break
-  assert n>=len(lines)-1,(n,len(lines),'something off with our iterator logic')
-  if n==len(lines)-1:
-    lines[-1].mark=doc.create_mark(None,doc.get_end_iter(),False)
-  return lines
-  
-def mark_changed_lines(doc,original,current):
-  'unfortunate choice of name, has nothing to do with GtkTextBuffer marks'
+Split_Off_Indent_Pattern = re.compile('(\s*)(.*)$')
 
-  # presume all current lines are changed
-  for line in current:
-    line.changed = True
+class DocLines:
+  """The lines of a document, kept up to date from the buffer's insert-text and
+  delete-range signals. An edit only marks the lines it touched, which are read
+  and classified again on the next update(). Line indices (line.i) are not kept
+  up to date here, downsample_lines sets them.
   
-  # mark any original lines we find as unchanged
-  start = doc.get_start_iter()
-  c=0
-  for oline in original:
-    end = doc.get_iter_at_mark(oline.mark)
-    slice = doc.get_slice(start,end)
-    # see if the first line between the marks is the original line
-    if slice.split('\n',1)[0] == oline.raw:
-      current[c].changed = False
-    # forward through all the slice lines
-    c += slice.count('\n')
-
-    start = end
-
-  return current
-      
-def lines_mark_search_matches(lines,docrec):
-  for line in lines:
-    if docrec.search_text and docrec.search_text in line.raw:
-      line.search_match = True
-    else:
-      line.search_match = False
-  return lines
+  Once set_original() has been called, every line also knows the original line
+  it still is (line.orig) and whether it was changed. An edited range remembers
+  the original lines it replaced (line.origs of its old lines), and on update()
+  its new lines are matched against those in order, so the cost of an edit only
+  depends on its size.
   
-Split_Off_Indent_Pattern = re.compile('(\s*)(.*)$')
+  Lines with the same text can be matched to the wrong one of several equal
+  original lines. The lines around such a match share their original lines in
+  a group (line.group), and an edit to any of them reads the whole group again,
+  together with up to UNSETTLED_MAX changed lines on each side, so that undoing
+  the edits matches the lines again."""
+  def __init__(me, doc):
+    me.doc = doc
+    me.lines = document_lines(doc)
+    for line in me.lines:
+      line.orig = None
+      line.origs = []
+      line.group = None
+      line.changed = False
+    # a line to read again is None in lines until update(), and the original
+    # lines an edit replaced are kept in pending at the index of its first line
+    me.pending = [None]*len(me.lines)
+    me.dirty = False
+    me.original = None # the text of the original lines
+    me.version = 0 # counts the edits
+    me.search_text = None
+    # before the default handlers, the iters still point into the old text
+    me.handler_ids = [doc.connect("insert-text", me.on_insert_text),
+                      doc.connect("delete-range", me.on_delete_range)]
+    
+  def disconnect(me):
+    for handler_id in me.handler_ids:
+      me.doc.disconnect(handler_id)
+    me.handler_ids = []
+    
+  def on_insert_text(me, doc, piter, text, len):
+    L = piter.get_line()
+    me.replace_lines(L, L+1, text.count('\n')+1)
+    
+  def on_delete_range(me, doc, start, end):
+    a, b = sorted((start.get_line(), end.get_line()))
+    me.replace_lines(a, b+1, 1)
+    
+  def replace_lines(me, start, end, count):
+    "the old lines [start,end) were replaced by count lines"
+    me.version += 1
+    me.dirty = True
+    lines = me.lines
+    # the edit also reads again the groups and the changed lines around it, so
+    # that undoing it matches them to their original lines again
+    if me.original is not None:
+      taken = 0
+      while start > 0 and me.unsettled(lines[start-1], taken):
+        start -= 1
+        count += 1
+        taken += 1
+      taken = 0
+      while end < len(lines) and me.unsettled(lines[end], taken):
+        end += 1
+        count += 1
+        taken += 1
+    origs = []
+    groups = set()
+    for line in lines[start:end]:
+      if line is None:
+        pass
+      elif line.group is None:
+        origs.extend(line.origs)
+      elif id(line.group) not in groups:
+        groups.add(id(line.group))
+        origs.extend(line.group.origs)
+    for pending in me.pending[start:end]:
+      if pending:
+        origs.extend(pending)
+    me.lines[start:end] = [None]*count
+    me.pending[start:end] = [origs or None] + [None]*(count-1)
+    
+  def unsettled(me, line, taken):
+    "whether to read line again with an edit next to it"
+    if line is None:
+      return False
+    if line.group is not None: # groups are always read as a whole
+      return True
+    return taken < UNSETTLED_MAX and (line.changed or len(line.origs) != 1)
+    
+  def set_original(me):
+    "take the current text as the original, that changes are shown against"
+    me.update()
+    me.original = [line.raw for line in me.lines]
+    me.original_count = {} # how often each text is in the original lines
+    for raw in me.original:
+      me.original_count[raw] = me.original_count.get(raw, 0)+1
+    for i, line in enumerate(me.lines):
+      line.orig = i
+      line.origs = [i]
+      line.group = None
+      line.changed = False
+    me.version += 1
+    
+  def set_search_text(me, search_text):
+    if search_text == me.search_text:
+      return
+    me.search_text = search_text
+    for line in me.lines:
+      if line is not None:
+        line.search_match = bool(search_text) and search_text in line.raw
+        
+  def update(me):
+    if not me.dirty:
+      return me.lines
+    doc = me.doc
+    lines = me.lines
+    count = doc.get_line_count()
+    end = 0
+    while 1:
+      # the edited lines are found again as the runs of None
+      try:
+        start = lines.index(None, end)
+      except ValueError:
+        break
+      end = start+1
+      while end < len(lines) and lines[end] is None:
+        end += 1
+      origs = []
+      for pending in me.pending[start:end]:
+        if pending:
+          origs.extend(pending)
+      origs.sort()
+      me.pending[start:end] = [None]*(end-start)
+      
+      it = doc.get_iter_at_line(start)
+      if end < count:
+        rows = doc.get_text(it, doc.get_iter_at_line(end)).split('\n')[:-1]
+      else:
+        rows = doc.get_text(it, doc.get_end_iter()).split('\n')
+      new = [make_line(start+k, raw) for k, raw in enumerate(rows)]
+      me.match_original(new, origs)
+      if me.search_text:
+        for line in new:
+          line.search_match = me.search_text in line.raw
+      lines[start:end] = new
+    me.dirty = False
+    return lines
+    
+  def match_original(me, lines, origs):
+    "match lines in order to the original lines origs they replaced"
+    for line in lines:
+      line.orig = None
+      line.origs = []
+      line.group = None
+      line.changed = False
+    if me.original is None:
+      return
+    where = {}
+    for k, o in enumerate(origs):
+      where.setdefault(me.original[o], []).append(k)
+    k = 0
+    matches = []
+    for i, line in enumerate(lines):
+      ks = where.get(line.raw)
+      if ks:
+        j = bisect_left(ks, k)
+        if j < len(ks):
+          k = ks[j]+1
+          line.orig = origs[ks[j]]
+          matches.append((i, ks[j]))
+      line.changed = line.orig is None
+    # the other original lines stay with the lines between the same matches,
+    # so they are matched again when the edit is undone
+    prev_i = prev_k = -1
+    joined = set()
+    for i, k in matches + [(len(lines), len(origs))]:
+      if i < len(lines):
+        lines[i].origs.append(origs[k])
+      rest = origs[prev_k+1:k]
+      if rest:
+        gap = lines[prev_i+1:i]
+        if not gap:
+          gap = [lines[min(i, len(lines)-1)]]
+          joined.update([prev_i, i])
+        for t, o in enumerate(rest):
+          gap[min(t, len(gap)-1)].origs.append(o)
+      prev_i, prev_k = i, k
+    # the lines between two matches of text that is only once in the original
+    # are grouped, unless they all matched; so are the two lines around other
+    # original lines that had no line between them
+    segment = []
+    for i, line in enumerate(lines):
+      unique = (line.orig is not None and me.original_count[line.raw] == 1
+                and i not in joined)
+      if not unique:
+        segment.append(line)
+      if (unique or i == len(lines)-1) and segment:
+        me.group_lines(segment)
+        segment = []
+        
+  def group_lines(me, lines):
+    "let lines share their original lines if one of them may be matched wrong"
+    matched = [line for line in lines if line.orig is not None]
+    origs = []
+    for line in lines:
+      origs.extend(line.origs)
+    if not matched or len(matched) == len(lines) == len(origs):
+      return
+    group = struct()
+    group.origs = sorted(origs)
+    for line in lines:
+      line.group = group
       
 class TextmapView(gtk.VBox):
   def __init__(me, geditwin):
@@ -655,15 +849,21 @@ class TextmapView(gtk.VBox):
     me.darea = darea
     #probj(me.darea)
 
-    me.connected = {}
-    me.draw_scrollbar_only = False
+    me.connected = {} # id(doc or view) -> (doc or view, handler ids)
     me.draw_sections = False
     me.topL = None
     me.surface_textmap = None
+    me.surface_key = None
+    me.surface_version = None
+    me.surface_scale = None
+    me.drawn = []
     
     me.line_count = 0
     
     me.doc_attached_data = {}
+    me.lines = []
+    
+    me.tab_removed_id = geditwin.connect("tab-removed", me.on_tab_removed)
     
     me.show_all()
     
@@ -692,6 +892,32 @@ class TextmapView(gtk.VBox):
      #                               self.vruler)
      #'''
   
+  def on_tab_removed(me, geditwin, tab):
+    me.forget(tab.get_document())
+    me.forget(tab.get_view())
+    
+  def forget(me, ob):
+    "disconnect from a document or view and drop what we keep for it"
+    if id(ob) in me.connected:
+      ob, handler_ids = me.connected.pop(id(ob))
+      for handler_id in handler_ids:
+        ob.disconnect(handler_id)
+    docrec = me.doc_attached_data.pop(id(ob), None)
+    if docrec is not None:
+      docrec.doc_lines.disconnect()
+    if me.surface_key and me.surface_key[0] == id(ob):
+      me.surface_textmap = None
+      me.surface_key = None
+      me.lines = []
+      
+  def deactivate(me):
+    me.geditwin.disconnect(me.tab_removed_id)
+    for ob, handler_ids in me.connected.values():
+      me.forget(ob)
+    for docrec in me.doc_attached_data.values():
+      docrec.doc_lines.disconnect()
+    me.doc_attached_data = {}
+    
   def on_darea_motion_notify_event(me, widget, event):
     #probj(event)
     #print event.type
@@ -745,14 +971,10 @@ class TextmapView(gtk.VBox):
     topL = visible_lines_top_bottom(me.geditwin)[0]
     if topL <> me.topL:
       queue_refresh(me)
-      me.draw_scrollbar_only = True
-    
-  def on_insert_text(me, doc, piter, text, len):
-    pass
-    #if len < 20 and '\n' in text:
-    #  print 'piter',piter,'text',repr(text),'len',len
     
   def scroll_from_y_mouse_pos(me,y):
+    if not me.lines:
+      return
     for line in me.lines:
       if line.y > y:
         break
@@ -776,15 +998,12 @@ class TextmapView(gtk.VBox):
     if time.time()-me.last_scroll_time > .47:
       if me.draw_sections:
         me.draw_sections = False
-        me.draw_scrollbar_only = False
         queue_refresh(me)
     return False
     
   def on_scroll_event(me,view,event):
     me.last_scroll_time = time.time()
-    if me.draw_sections: # we are in the middle of scrolling
-      me.draw_scrollbar_only = True
-    else:
+    if not me.draw_sections:
       me.draw_sections = True # for the first scroll, turn on section names
     gobject.timeout_add(500,me.on_scroll_finished) # this will fade out sections
     queue_refresh(me)
@@ -812,10 +1031,8 @@ class TextmapView(gtk.VBox):
       return
     
     if id(doc) not in me.connected:
-      me.connected[id(doc)] = True
-      doc.connect("cursor-moved", me.on_doc_cursor_moved)
-      doc.connect("insert-text", me.on_insert_text)
-      doc.connect("search-highlight-updated", me.on_search_highlight_updated)
+      me.connected[id(doc)] = (doc, [doc.connect("cursor-moved", me.on_doc_cursor_moved),
+                                     doc.connect("search-highlight-updated", me.on_search_highlight_updated)])
       
     view = me.geditwin.get_active_view()
     if not view:
@@ -824,8 +1041,7 @@ class TextmapView(gtk.VBox):
     if TIMER: TIMER.push('expose')
     
     if id(view) not in me.connected:
-      me.connected[id(view)] = True
-      view.connect("scroll-event", me.on_scroll_event)
+      me.connected[id(view)] = (view, [view.connect("scroll-event", me.on_scroll_event)])
       #view.connect("start-interactive-goto-line", me.test_event)
       #view.connect("start-interactive-search", me.test_event)
       #view.connect("reset-searched-text", me.test_event)
@@ -842,24 +1058,6 @@ class TextmapView(gtk.VBox):
     except Exception,e:
       pass  # probably an older version of gedit, no style schemes yet
     
-    changeCLR = (1,0,1)
-    
-    #search_match_style = None
-    #try:
-    #  search_match_style = doc.get_style_scheme().get_style('search-match')
-    #except:
-    #  pass
-    #if search_match_style is None:
-    #  searchFG = fg
-    #  searchBG = (0,1,0)
-    #else:
-    #  searchFG,searchBG = map(str2rgb, style.get_properties('foreground','background'))
-    searchFG = fg
-    searchBG = (0,1,0)
-      
-    
-    #print doc
-       
     try:
       win = widget.get_window()
     except AttributeError:
@@ -869,61 +1067,57 @@ class TextmapView(gtk.VBox):
     
     #probj(cr,'rgb')
     
-    # Are we drawing everything, or just the scrollbar?
-    fontfamily = 'sans-serif'
     cr.select_font_face('monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+    
+    if BUG_MASK & BUG_DOC_GET_SEARCH_TEXT:
+      search_text = None
+    else:
+      search_text = doc.get_search_text()[0]
+    
+    # The map is drawn to an off-screen surface, kept until the document, the
+    # search, the size or the colors change. Scrolling only draws the scrollbar
+    # over it.
+    docrec = me.doc_attached_data.get(id(doc))
+    if docrec is None or docrec.doc_lines.original is None:
+      version = None  # the changed lines are not known yet
+    else:
+      version = docrec.doc_lines.version
+    key = (id(doc), w, h, me.draw_sections, fg, bg, search_text)
             
-    if me.surface_textmap is None or not me.draw_scrollbar_only:
+    if me.surface_textmap is None or key != me.surface_key or version is None or version != me.surface_version:
     
       if TIMER: TIMER.push('document_lines')
 
-      lines = document_lines(doc)
-      
-      if TIMER: TIMER.pop('document_lines')
-      
-      if TIMER: TIMER.push('draw textmap')
-      
-      if id(doc) not in me.doc_attached_data:
+      if docrec is None:
         docrec = struct()
         me.doc_attached_data[id(doc)] = docrec
-        docrec.original_lines_info = None # we skip the first one, its empty
+        docrec.doc_lines = DocLines(doc) # we skip the first one, its empty
         docrec.search_text = None
-        for l in lines:
-          l.changed = False
+        docrec.downsample_key = None
+      elif docrec.doc_lines.original is None:
+        docrec.doc_lines.set_original()
+      lines = docrec.doc_lines.update()
+      if docrec.doc_lines.original is None:
+        version = None
       else:
-        docrec = me.doc_attached_data[id(doc)]
-        if docrec.original_lines_info == None:
-          docrec.original_lines_info = init_original_lines_info(doc,lines)
-        lines = mark_changed_lines(doc, docrec.original_lines_info, lines)
-        
-      if BUG_MASK & BUG_DOC_GET_SEARCH_TEXT:
-        pass
-      else:
-        docrec.search_text = doc.get_search_text()[0]
-        lines = lines_mark_search_matches(lines,docrec)
-     
-      cr.push_group()
+        version = docrec.doc_lines.version # set_original() counts as an edit
+
+      if search_text is not None:
+        docrec.search_text = search_text
+        docrec.doc_lines.set_search_text(docrec.search_text)
       
-      # bg
-      if 1:
-        #cr.set_source_rgb(46/256.,52/256.,54/256.)
-        cr.set_source_rgb(*bg)
-        cr.move_to(0,0)
-        cr.rectangle(0,0,w,h)
-        cr.fill()
-        cr.move_to(0,0)
+      if TIMER: TIMER.pop('document_lines')
+      
+      if TIMER: TIMER.push('draw textmap')
       
-      if not lines:
-        return
-        
-      # translate everthing in
-      margin = 3
-      cr.translate(margin,0)
-      w -= margin # an d here
-            
       if TIMER: TIMER.push('downsample')
       max_scale = 3
-      lines, scale, downsampled = downsample_lines(lines, h, 2, max_scale)
+      # the downsampled lines only change with the document and the search
+      downsample_key = (h, version, search_text)
+      if docrec.downsample_key != downsample_key:
+        docrec.downsampled = downsample_lines(lines, h, 2, max_scale)
+        docrec.downsample_key = downsample_key
+      lines, scale, downsampled = docrec.downsampled
       if TIMER: TIMER.pop('downsample')
       
       smooshed = False
@@ -937,188 +1131,45 @@ class TextmapView(gtk.VBox):
       if TIMER: TIMER.push('lines_mark_changed_sections')
       lines = lines_mark_changed_sections(lines)
       if TIMER: TIMER.pop('lines_mark_changed_sections')
-
-      n = len(lines)
-      lineH = h/n
-      
-      #print 'doc',doc.get_uri(), lines[0].raw
       
       if BUG_MASK & BUG_CAIRO_MAC_FONT_REF and me.font_face_keepalive is None:
         me.save_refs_to_all_font_faces(cr,scale,scale+3,10,12)
       
-      cr.set_font_size(scale)
-      whitespaceW = text_extents('.',cr)[0]
-      #print pr_text_extents(' ',cr)
-      #print pr_text_extents('.',cr)
-      #print pr_text_extents(' .',cr)
-      
-      # ------------------------ display text silhouette -----------------------
-      if TIMER: TIMER.push('draw silhouette')
-      
-      if dark(*fg):
-        faded_fg = lighten(.5,*fg)
-      else:
-        faded_fg = darken(.5,*fg)
-          
-      rectH = h/float(len(lines))
-      sofarH= 0
-      sections = []
-      for i, line in enumerate(lines):
+      lines_add_y(lines, h, scale, smooshed, cr)
       
-        line.y = sofarH
-        lastH = sofarH
-        cr.set_font_size(scale)
-        
-        if line.raw.strip(): # there is some text here
-            
-          tw,th = text_extents(line.raw,cr)
-        
-          if line.search_match:
-            cr.set_source_rgb(*searchBG)
-          elif line.changed:
-            cr.set_source_rgb(*changeCLR)
-          elif me.draw_sections:
-            cr.set_source_rgb(*faded_fg)
-          else:
-            cr.set_source_rgb(*fg)
-            
-          if line.section or line.subsection:
-            #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
-            cr.set_font_size(scale+3)
-            if line.justextSTR:
-              x,y = cr.get_current_point()
-              cr.move_to(whitespaceW*line.indent,y)
-              cr.show_text(line.justextSTR)
-            else:
-              cr.show_text(line.raw)
-          else:
-            #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-            cr.set_font_size(scale)
-            cr.show_text(line.raw)
-          
-          if smooshed:
-            sofarH += lineH
-          else:
-            sofarH += th
-        else: # empty line
-          if smooshed:
-            sofarH += lineH
-          else:
-            sofarH += scale-1
-          
-        if line.section:
-          sections.append((line, lastH))
-          
-        cr.move_to(0, sofarH)
-        
-      if TIMER: TIMER.pop('draw silhouette')
-          
-      # ------------------- display sections and subsections labels  ------------------
-
-      if me.draw_sections:
-        # Subsections
-        
-        if TIMER: TIMER.push('draw subsections')
+      # When the lines of the map stay in place, only the bands around the
+      # lines that look different are drawn again.
+      drawn = [(line.i, line.y, line.raw, line.changed, line.search_match) for line in lines]
+      band_ys = None
+      if me.surface_textmap is not None and key == me.surface_key and scale == me.surface_scale and len(drawn) == len(me.drawn):
+        band_ys = []
+        for old, new in zip(me.drawn, drawn):
+          if old[:2] != new[:2]:
+            band_ys = None
+            break
+          if old != new:
+            band_ys.append(new[1])
+        if band_ys is not None and len(band_ys) > len(drawn)/4:
+          band_ys = None
         
-        if dark(*bg):
-          bg_rect_C = lighten(.1,*bg)
-        else:
-          bg_rect_C = darken(.1,*bg)
-          
-        if 0: # - blot out the background -
-          cr.set_source_rgba(bg_rect_C[0],bg_rect_C[1],bg_rect_C[2],.5)
-          cr.rectangle(0,0,w,h)
-          cr.fill()
-        
-        cr.new_path()
-        cr.set_line_width(1.5)
-        subsW = 10
-        subsmargin = 10
-        cr.set_font_size(10)
-        for line in lines:
-          if line.subsection:
-            if 0:
-              cr.move_to(subsmargin,line.y)
-              cr.line_to(subsmargin+subsW,line.y)
-            #if line.subsectionchanged:
-            #  cr.set_source_rgb(*changeCLR)
-            #else:
-            #  cr.set_source_rgb(*fg)
-            if 0:
-              cr.set_source_rgb(*fg)
-              cr.arc(subsmargin,line.y+3,2,0,6.28)
-              cr.stroke()
-            if 1:
-              #cr.move_to(20,line.y)
-              cr.set_source_rgb(*fg)
-              #cr.show_text(line.subsection)
-              cr.move_to(whitespaceW*line.indent,line.y)
-              #cr.move_to(10,line.y)
-              #fit_text(line.subsection, 10000, 10000, fg, bg, cr)
-              show_section_label(line.subsection, fg, bg_rect_C, cr)
-              
-        if TIMER: TIMER.pop('draw subsections')
-        
-        # Sections
-        
-        if TIMER: TIMER.push('draw sections')
-        cr.set_font_size(12)
-        for line, lastH in sections:
-        
-          if 0: # section lines
-            cr.move_to(0, lastH)
-            cr.set_line_width(1)
-            cr.set_source_rgb(*fg)
-            cr.line_to(w,lastH)
-            cr.stroke()
-          
-          if 1: # section heading
-            cr.move_to(0,lastH)
-            #if line.sectionchanged:
-            #  cr.set_source_rgb(*changeCLR)
-            #else:
-            #  cr.set_source_rgb(*fg)
-            cr.set_source_rgb(*fg)         
-            #dispnfo = fit_text(line.section,4*w/5,line.section_len*rectH,fg,bg,cr)
-            show_section_label(line.section, fg, bg_rect_C, cr)
-            
-          if 0 and dispnfo: # section hatches
-            cr.set_line_width(1)
-            r=dispnfo[0] # first line
-            cr.move_to(r.x+r.tw+2,r.y-r.th/2+2)
-            cr.line_to(w,r.y-r.th/2+2)
-            cr.stroke()
-            
-        if TIMER: TIMER.pop('draw sections')
-          
-      # ------------------ translate back for the scroll bar -------------------
-      
-      cr.translate(-margin,0)
-      w += margin
-
-      # -------------------------- mark lines markers --------------------------
-            
-      if TIMER: TIMER.push('draw line markers')
-      for line in lines:
-        if line.search_match:
-          clr = searchBG
-        elif line.changed:
-          clr = changeCLR
-        else:
-          continue # nothing interesting has happened with this line
-        cr.set_source_rgb(*clr)      
-        cr.rectangle(w-3,line.y-2,2,5)
-        cr.fill()
-      if TIMER: TIMER.pop('draw line markers')
+      if band_ys is None:
+        me.surface_textmap = cr.get_target().create_similar(cairo.CONTENT_COLOR, int(w), int(h))
+      if band_ys is None or band_ys:
+        scr = cairo.Context(me.surface_textmap)
+        scr.select_font_face('monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        me.draw_textmap(scr, lines, w, h, scale, smooshed, fg, bg, band_ys)
         
       if TIMER: TIMER.pop('draw textmap')
       
       # save
-      me.surface_textmap = cr.pop_group() # everything but the scrollbar
+      me.surface_key = key
+      me.surface_version = version
+      me.surface_scale = scale
+      me.drawn = drawn
       me.lines = lines
 
     if TIMER: TIMER.push('surface_textmap')
-    cr.set_source(me.surface_textmap)
+    cr.set_source_surface(me.surface_textmap,0,0)
     cr.rectangle(0,0,w,h)
     cr.fill()
     if TIMER: TIMER.pop('surface_textmap')
@@ -1137,10 +1188,207 @@ class TextmapView(gtk.VBox):
     if TIMER: TIMER.pop('scrollbar')
     
     me.topL = topL
-    me.draw_scrollbar_only = False
     
     if TIMER: TIMER.pop('expose')
     if TIMER: TIMER.print_()
+    
+  def draw_textmap(me, cr, lines, w, h, scale, smooshed, fg, bg, band_ys=None):
+    "draw the map of lines, or only the bands around the y positions in band_ys"
+    
+    changeCLR = (1,0,1)
+    
+    #search_match_style = None
+    #try:
+    #  search_match_style = doc.get_style_scheme().get_style('search-match')
+    #except:
+    #  pass
+    #if search_match_style is None:
+    #  searchFG = fg
+    #  searchBG = (0,1,0)
+    #else:
+    #  searchFG,searchBG = map(str2rgb, style.get_properties('foreground','background'))
+    searchFG = fg
+    searchBG = (0,1,0)
+    
+    if band_ys is None:
+      near = lambda y: True
+    else:
+      # anything drawn within BAND of a changed line is clipped to the bands,
+      # everything that may reach into them is drawn again
+      for y in band_ys:
+        cr.rectangle(0,y-BAND,w,2*BAND)
+      cr.clip()
+      def near(y):
+        j = bisect_left(band_ys,y-2*BAND)
+        return j < len(band_ys) and band_ys[j] <= y+2*BAND
+        
+    # bg
+    if 1:
+      #cr.set_source_rgb(46/256.,52/256.,54/256.)
+      cr.set_source_rgb(*bg)
+      cr.move_to(0,0)
+      cr.rectangle(0,0,w,h)
+      cr.fill()
+      cr.move_to(0,0)
+      
+    # translate everthing in
+    margin = 3
+    cr.translate(margin,0)
+    w -= margin # an d here
+    
+    cr.set_font_size(scale)
+    whitespaceW = text_extents('.',cr)[0]
+    #print pr_text_extents(' ',cr)
+    #print pr_text_extents('.',cr)
+    #print pr_text_extents(' .',cr)
+    
+    # ------------------------ display text silhouette -----------------------
+    if TIMER: TIMER.push('draw silhouette')
+    
+    if dark(*fg):
+      faded_fg = lighten(.5,*fg)
+    else:
+      faded_fg = darken(.5,*fg)
+        
+    sections = []
+    for line in lines:
+    
+      if line.section:
+        sections.append((line, line.y))
+        
+      if not near(line.y):
+        continue
+        
+      cr.move_to(0, line.y)
+      
+      if line.raw.strip(): # there is some text here
+      
+        if line.search_match:
+          cr.set_source_rgb(*searchBG)
+        elif line.changed:
+          cr.set_source_rgb(*changeCLR)
+        elif me.draw_sections:
+          cr.set_source_rgb(*faded_fg)
+        else:
+          cr.set_source_rgb(*fg)
+          
+        if line.section or line.subsection:
+          #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+          cr.set_font_size(scale+3)
+          if line.justextSTR:
+            cr.move_to(whitespaceW*line.indent,line.y)
+            cr.show_text(line.justextSTR)
+          else:
+            cr.show_text(line.raw)
+        else:
+          #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+          cr.set_font_size(scale)
+          cr.show_text(line.raw)
+        
+    if TIMER: TIMER.pop('draw silhouette')
+        
+    # ------------------- display sections and subsections labels  ------------------
+
+    if me.draw_sections:
+      # Subsections
+      
+      if TIMER: TIMER.push('draw subsections')
+      
+      if dark(*bg):
+        bg_rect_C = lighten(.1,*bg)
+      else:
+        bg_rect_C = darken(.1,*bg)
+        
+      if 0: # - blot out the background -
+        cr.set_source_rgba(bg_rect_C[0],bg_rect_C[1],bg_rect_C[2],.5)
+        cr.rectangle(0,0,w,h)
+        cr.fill()
+      
+      cr.new_path()
+      cr.set_line_width(1.5)
+      subsW = 10
+      subsmargin = 10
+      cr.set_font_size(10)
+      for line in lines:
+        if line.subsection and near(line.y):
+          if 0:
+            cr.move_to(subsmargin,line.y)
+            cr.line_to(subsmargin+subsW,line.y)
+          #if line.subsectionchanged:
+          #  cr.set_source_rgb(*changeCLR)
+          #else:
+          #  cr.set_source_rgb(*fg)
+          if 0:
+            cr.set_source_rgb(*fg)
+            cr.arc(subsmargin,line.y+3,2,0,6.28)
+            cr.stroke()
+          if 1:
+            #cr.move_to(20,line.y)
+            cr.set_source_rgb(*fg)
+            #cr.show_text(line.subsection)
+            cr.move_to(whitespaceW*line.indent,line.y)
+            #cr.move_to(10,line.y)
+            #fit_text(line.subsection, 10000, 10000, fg, bg, cr)
+            show_section_label(line.subsection, fg, bg_rect_C, cr)
+            
+      if TIMER: TIMER.pop('draw subsections')
+      
+      # Sections
+      
+      if TIMER: TIMER.push('draw sections')
+      cr.set_font_size(12)
+      for line, lastH in sections:
+      
+        if not near(lastH):
+          continue
+      
+        if 0: # section lines
+          cr.move_to(0, lastH)
+          cr.set_line_width(1)
+          cr.set_source_rgb(*fg)
+          cr.line_to(w,lastH)
+          cr.stroke()
+        
+        if 1: # section heading
+          cr.move_to(0,lastH)
+          #if line.sectionchanged:
+          #  cr.set_source_rgb(*changeCLR)
+          #else:
+          #  cr.set_source_rgb(*fg)
+          cr.set_source_rgb(*fg)         
+          #dispnfo = fit_text(line.section,4*w/5,line.section_len*rectH,fg,bg,cr)
+          show_section_label(line.section, fg, bg_rect_C, cr)
+          
+        if 0 and dispnfo: # section hatches
+          cr.set_line_width(1)
+          r=dispnfo[0] # first line
+          cr.move_to(r.x+r.tw+2,r.y-r.th/2+2)
+          cr.line_to(w,r.y-r.th/2+2)
+          cr.stroke()
+          
+      if TIMER: TIMER.pop('draw sections')
+        
+    # ------------------ translate back for the scroll bar -------------------
+    
+    cr.translate(-margin,0)
+    w += margin
+
+    # -------------------------- mark lines markers --------------------------
+          
+    if TIMER: TIMER.push('draw line markers')
+    for line in lines:
+      if line.search_match:
+        clr = searchBG
+      elif line.changed:
+        clr = changeCLR
+      else:
+        continue # nothing interesting has happened with this line
+      if not near(line.y):
+        continue
+      cr.set_source_rgb(*clr)      
+      cr.rectangle(w-3,line.y-2,2,5)
+      cr.fill()
+    if TIMER: TIMER.pop('draw line markers')
       
         
 class TextmapWindowHelper:
@@ -1157,6 +1405,8 @@ class TextmapWindowHelper:
     me.panel = panel
 
   def deactivate(me):
+    me.textmapview.deactivate()
+    me.panel.remove_item(me.textmapview)
     me.window = None
     me.plugin = None
     me.textmapview = None
@@ -1,5 +1,92 @@
-from gi.repository import Gtk, Gio, GObject, Gedit
+from gi.repository import Gtk, Gio, GObject, GLib, Gedit
 import os
+import fcntl
+import subprocess
+from urllib.parse import unquote
+
+
+class SearchJob:
+    """
+    Runs one grep over a directory tree in the background. grep gets its
+    arguments as a list and walks the tree itself, so nothing passes
+    through a shell and no file list has to fit on a command line.
+    Results are handed to on_results in batches, one batch per block of
+    output read.
+    """
+    read_size = 65536
+
+    def __init__(self, location, query, case_sensitive, scan_logs,
+                 on_results, on_finished):
+        args = ['grep', '-r', '-n', '-H', '-I', '-Z',
+                '--exclude-dir=.svn', '--exclude-dir=.git']
+        if not scan_logs:
+            args.extend(['--exclude=*.log', '--exclude=*.bak'])
+        if not case_sensitive:
+            args.append('-i')
+        args.extend(['-e', query, '--', location])
+
+        self.on_results = on_results
+        self.on_finished = on_finished
+        self.buffer = b''
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        fd = self.process.stdout.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.watch = GLib.io_add_watch(
+            fd, GLib.PRIORITY_LOW,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.read_output)
+
+    def running(self):
+        return self.watch is not None
+
+    def cancel(self):
+        if self.watch is None:
+            return
+        GLib.source_remove(self.watch)
+        self.watch = None
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+    def read_output(self, fd, condition):
+        try:
+            data = os.read(fd, self.read_size)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+
+        if data:
+            lines = (self.buffer + data).split(b"\n")
+            self.buffer = lines.pop()
+        else:
+            lines = [self.buffer]
+            self.buffer = b''
+
+        # Each line looks like this
+        # (-Z ends the file name with a NUL byte):
+        #   FILE (absolute path)\0Line number:string
+        results = []
+        for each in lines:
+            (path, sep, rest) = each.partition(b"\0")
+            pieces = rest.split(b":", 1)
+            if sep and len(pieces) == 2:
+                results.append((os.fsdecode(path),
+                                pieces[0].decode("ascii"),
+                                pieces[1].decode("utf-8", "replace")))
+        if results:
+            self.on_results(results)
+
+        if data or self.watch is None:
+            # on_results may have cancelled the job
+            return self.watch is not None
+
+        self.watch = None
+        self.process.wait()
+        self.on_finished()
+        return False
 
 
 class ResultsView(Gtk.VBox):
@@ -22,6 +109,11 @@ class ResultsView(Gtk.VBox):
         self.case_sensitive = False
         self.scan_logs = False
 
+        # The search running in the background, and the number of results
+        # after which it is stopped
+        self.search_job = None
+        self.result_limit = 1000
+
         # We save the grep search result data in a ListStore
         # Format:  ID (COUNT)  |  FILE (without path)
         # |  LINE  |  FILE (with path)
@@ -86,10 +178,16 @@ class ResultsView(Gtk.VBox):
         self.search_form = Gtk.Entry()
         self.search_form.connect("activate", self.button_press)
 
+        # Create a "Stop" button to cancel a running search
+        self.button_stop = Gtk.Button("Stop")
+        self.button_stop.connect("clicked", self.stop_search)
+        self.button_stop.set_sensitive(False)
+
         # Here's the HBox I mentioned...
         search_box = Gtk.HBox(False, 0)
         search_box.pack_start(self.search_form, False, False, 0)
         search_box.pack_start(button_find, False, False, 0)
+        search_box.pack_start(self.button_stop, False, False, 0)
 
         # Pack the search box (search bar + Find button) into the side panel
         self.pack_start(search_box, False, False, 0)
@@ -112,6 +210,10 @@ class ResultsView(Gtk.VBox):
         # Pack it in...
         self.pack_start(self.check_logs, False, False, 0)
 
+        # Create a label to show the search status
+        self.status_label = Gtk.Label()
+        self.pack_start(self.status_label, False, False, 0)
+
         # Show all UI elements
         self.show_all()
 
@@ -188,67 +290,60 @@ class ResultsView(Gtk.VBox):
         if (len(self.search_form.get_text()) <= 0):
             return
 
-        # Create a string that will hold all of the filenames;
-        # we'll append it to the grep command string.
-        string = ""
-
         fbroot = self.get_filebrowser_root()
         if fbroot != "" and fbroot is not None:
-            location = fbroot.replace("file://", "")
-            location = location.replace("%20", "\\ ")
+            location = unquote(fbroot.replace("file://", ""))
         else:
             return
 
-        #if (not)
-        #" -type f -not -regex '.*/.svn.*'"
-        #" -type f -not -regex '.*/(.svn|.log|.bak).*'"
-        search_filter = ' -type f | egrep -v ".*(\.svn.*|\.git.*)"'
-        if (not self.scan_logs):
-            search_filter = ' -type f | egrep -v ".*(\.svn.*|\.git.*|\.log|\.bak)"'
-
-        hooray = os.popen("find " + location + search_filter).readlines()
-        for hip in hooray:
-            string += " \"%s\"" % hip[:-1]
-
-        # str_case_operator will hold the "case insensitive"
-        # command if necessary
-        str_case_operator = ""
-        if (not self.case_sensitive):
-            str_case_operator = " -i"
-
-       # Create a pipe and call the grep command, then read it
-        pipe = os.popen("grep -n -H" + str_case_operator + " %s %s" % (self.search_form.get_text(), string))
-        data = pipe.readlines()
-
-        results = data
+        # Stop any search that is still running
+        self.stop_search()
 
         # Clear any current results from the side panel
         self.search_data.clear()
 
-        # Process each result...
-        for each in results:
-            # Each result will look like this:
-            #   FILE (absolute path):Line number:string
-            #
-            #   ... where string is the line that the search data was found in.
-            pieces = each.split(":", 2)
-
-            if (len(pieces) == 3):
-                line_number = pieces[1]
-                # We just want the filename, not the path
-                filename = os.path.basename(pieces[0])
-                string = pieces[2].lstrip(" ")  # Remove leading whitespace
-
-                # If we want to ignore comments,
-                # then we'll make sure it doesn't start with # or //
-                if (self.ignore_comments):
-                    if (not string.startswith("#") and
-                        not string.startswith("//")):
-                        self.search_data.append(("%d" % (len(self.search_data)
-                         + 1), filename, line_number, pieces[0]))
-                else:
-                    self.search_data.append(("%d" % (len(self.search_data) +
-                     1), filename, line_number, pieces[0]))
+        self.search_job = SearchJob(location, self.search_form.get_text(),
+                                    self.case_sensitive, self.scan_logs,
+                                    self.add_results, self.search_finished)
+        self.button_stop.set_sensitive(True)
+        self.status_label.set_text("Searching...")
+
+    # The search job calls add_results with each batch of results it reads
+    def add_results(self, results):
+        for (path, line_number, string) in results:
+            # If we want to ignore comments,
+            # then we'll make sure it doesn't start with # or //
+            string = string.lstrip(" ")  # Remove leading whitespace
+            if (self.ignore_comments):
+                if (string.startswith("#") or string.startswith("//")):
+                    continue
+
+            # We just want the filename, not the path
+            filename = os.path.basename(path)
+            self.search_data.append(("%d" % (len(self.search_data) + 1),
+                                     filename, line_number, path))
+
+            if (len(self.search_data) >= self.result_limit):
+                self.stop_search()
+                self.status_label.set_text("Stopped after %d results" %
+                                           len(self.search_data))
+                return
+
+        self.status_label.set_text("Searching... %d results" %
+                                   len(self.search_data))
+
+    def search_finished(self):
+        self.search_job = None
+        self.button_stop.set_sensitive(False)
+        self.status_label.set_text("%d results" % len(self.search_data))
+
+    def stop_search(self, widget=None):
+        if self.search_job is not None:
+            self.search_job.cancel()
+            self.search_job = None
+            self.status_label.set_text("Stopped, %d results" %
+                                       len(self.search_data))
+        self.button_stop.set_sensitive(False)
 
     def get_filebrowser_root(self):
         base = u'org.gnome.gedit.plugins.filebrowser'
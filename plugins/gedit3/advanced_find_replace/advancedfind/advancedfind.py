@@ -30,7 +30,7 @@ import fnmatch
 import subprocess
 import urllib.request, urllib.parse, urllib.error
 import re
-#import time
+import time
 import shutil
 
 
@@ -38,6 +38,9 @@ from .advancedfind_ui import AdvancedFindUI
 from .find_result import FindResultView
 from . import config_manager
 from .config_ui import ConfigUI
+from .regex_cache import regex_cache
+from .multi_file import MultiFileEngine
+from .line_index import MatchResults, find_results
 
 
 import gettext
@@ -285,6 +288,11 @@ class AdvancedFindWindowHelper:
 		#'''
 
 	def create_regex(self, pattern, find_options):
+		key = regex_cache.key(pattern, find_options)
+		regex = regex_cache.get(key)
+		if regex:
+			return regex
+		
 		if find_options['REGEX_SEARCH'] == False:
 			try:
 				pattern = re.escape(str(r'%s' % pattern, "utf-8"))
@@ -306,8 +314,9 @@ class AdvancedFindWindowHelper:
 			regex = re.compile(pattern, re_flg)
 		except:
 			print('regex compile failed')
-			regex = None
+			return None
 		
+		regex_cache.put(key, regex)
 		return regex
 		
 	def advanced_find_in_doc(self, doc, search_pattern, find_options, forward_flg = True, replace_flg = False, around_flg = False):
@@ -461,23 +470,8 @@ class AdvancedFindWindowHelper:
 				tree_it = self._results_view.append_find_result_filename(parent_it, doc.get_short_name_for_display(), tab, uri)
 			
 			if replace_flg == False:
-				while(match):
-					line_num = doc.get_iter_at_offset(match.start()).get_line()
-					line_start_pos = doc.get_iter_at_line(line_num).get_offset()
-					match_end_line_cnt = doc.get_iter_at_offset(match.end()).get_line() + 1
-					if match_end_line_cnt == doc.get_line_count():
-						line_end_pos = end_pos
-					else:
-						line_end_pos = doc.get_iter_at_line(match_end_line_cnt).get_offset()
-					line_text = text[line_start_pos:line_end_pos]
-					self._results_view.append_find_result(tree_it, str(line_num+1), line_text, match.start(), match.end()-match.start(), "", line_start_pos)
-					if match.start() == match.end():
-						start_pos = match.end() + 1
-					else:
-						start_pos = match.end()
-					if start_pos > end_pos:
-						break
-					match = regex.search(text, start_pos, end_pos)
+				# line numbers and texts come from a line index of the text, not from text iters
+				self._results_view.append_find_results(tree_it, find_results(text, regex, start_pos, end_pos))
 			else:
 				results = []
 				replace_offset = 0
@@ -506,23 +500,7 @@ class AdvancedFindWindowHelper:
 				
 				start, end = doc.get_bounds()
 				text = str(doc.get_text(start, end, True))
-
-				for result in results:
-					line_num = doc.get_iter_at_offset(result[0]).get_line()
-					line_start_pos = doc.get_iter_at_line(line_num).get_offset()
-					#line_end_pos = result[0]+result[1]
-					match_end_line_cnt = doc.get_iter_at_offset(result[0]+result[1]).get_line() + 1
-					if match_end_line_cnt == doc.get_line_count():
-						line_end_pos = end_pos
-					else:
-						line_end_pos = doc.get_iter_at_line(match_end_line_cnt).get_offset()
-					'''
-					line_end_pos = doc.get_iter_at_line(doc.get_iter_at_offset(result[0]+result[1]).get_line()+1).get_offset()
-					if line_end_pos == line_start_pos:
-						line_end_pos = end_pos
-					#'''
-					line_text = text[line_start_pos:line_end_pos]
-					self._results_view.append_find_result(tree_it, str(line_num+1), line_text, result[0], result[1], "", line_start_pos, True)
+				self._results_view.append_find_results(tree_it, MatchResults(text, [(r[0], r[0] + r[1]) for r in results]), True)
 			
 		self.result_highlight_on(tree_it)
 	
@@ -570,7 +548,7 @@ class AdvancedFindWindowHelper:
 			print(e)
 
 		for f in p.stdout:
-			file_list.append(f[:-1])
+			file_list.append(os.fsdecode(f[:-1]))
 			
 		
 		'''
@@ -592,25 +570,56 @@ class AdvancedFindWindowHelper:
 		
 		self._results_view.is_busy(True)
 		self._results_view.do_events()
-					
-		for file_path in file_list:
-			if os.path.isfile(file_path):
-				temp_doc = Gedit.Document()
-				#file_uri = 'file://' + file_path
-				#temp_doc.load(Gio.file_new_for_uri(file_uri), Gedit.encoding_get_from_charset('utf-8'), 0, 0, False)
-				temp_doc.load(Gio.file_new_for_path(bytes.decode(file_path)), Gedit.encoding_get_from_charset('utf-8'), 0, 0, False)
-				f_temp = open(file_path, 'r')
-				try:
-					text = str(f_temp.read())
-				except:
-					text = f_temp.read()
-				f_temp.close()
-				temp_doc.set_text(text)
-				
-				self.advanced_find_all_in_doc(parent_it, temp_doc, search_pattern, find_options, replace_flg)
-				self.find_ui.do_events()
-				if self._results_view.stopButton.get_sensitive() == False:
-					break
+		
+		regex = self.create_regex(search_pattern, find_options)
+		if not regex:
+			self._results_view.is_busy(False)
+			return
+			
+		replace_text = None
+		if replace_flg == True:
+			replace_text = str(self.find_ui.replaceTextComboboxtext.get_active_text())
+			# open documents are replaced in their buffers, so unsaved changes are kept
+			open_docs = {}
+			for doc in self._window.get_documents():
+				location = doc.get_location()
+				if location and location.get_path():
+					open_docs[os.path.realpath(location.get_path())] = doc
+			closed_files = []
+			for file_path in file_list:
+				doc = open_docs.get(os.path.realpath(file_path))
+				if doc is None:
+					closed_files.append(file_path)
+				else:
+					self.advanced_find_all_in_doc(parent_it, doc, search_pattern, find_options, True)
+			file_list = closed_files
+			
+		engine = MultiFileEngine([f for f in file_list if os.path.isfile(f)], regex, replace_text, find_options['REGEX_SEARCH'])
+		busy_icon = os.path.join(os.path.dirname(__file__), 'loading.gif')
+		if replace_flg == True:
+			busy_text = _('Replacing...')
+		else:
+			busy_text = _('Finding...')
+		last_progress = 0
+		while True:
+			finished = engine.is_finished()
+			for file_path, results in engine.take_results():
+				if not results:
+					continue
+				tree_it = self._results_view.append_find_result_filename(parent_it, os.path.basename(file_path), None, file_path)
+				self._results_view.append_find_results(tree_it, results, replace_flg)
+			if finished:
+				break
+			if time.time() - last_progress > 0.5:
+				last_progress = time.time()
+				self.set_bottom_panel_label(busy_text + ' %d/%d files, %.0f files/s, %.1f MB/s' % engine.progress(), busy_icon)
+			self.find_ui.do_events()
+			if self._results_view.stopButton.get_sensitive() == False:
+				# files being processed are finished, so no file is left half replaced
+				engine.cancel()
+			engine.wait(0.05)
+		for file_path, error in engine.errors:
+			print('advancedfind: %s: %s' % (file_path, error))
 				
 		self._results_view.is_busy(False)
 				
@@ -627,6 +636,8 @@ class AdvancedFindWindowHelper:
 				return
 			for n in range(0,self._results_view.findResultTreemodel.iter_n_children(file_it)):
 				it = self._results_view.findResultTreemodel.iter_nth_child(file_it, n)
+				if self._results_view.findResultTreemodel.get_value(it, 0) == FindResultView.MORE_ROW:
+					continue
 				
 				result_start = self._results_view.findResultTreemodel.get_value(it, 4)
 				result_len = self._results_view.findResultTreemodel.get_value(it, 5)
@@ -490,6 +490,8 @@ class AdvancedFindUI(object):
 		doc = self._instance._window.get_active_document()
 		if not doc:
 			return
+		if self._instance.scopeFlg == 2 and not self.confirm_replace_in_dir():
+			return
 			
 		self._instance.set_bottom_panel_label(_('Replacing...'), os.path.join(os.path.dirname(__file__), 'loading.gif'))
 		#self._instance._results_view.set_sensitive(False)
@@ -514,10 +516,10 @@ class AdvancedFindUI(object):
 					break
 			self._instance._results_view.show_find_result()
 		elif self._instance.scopeFlg == 2: #files in directory
-			path = str(self._instance._results_view.findResultTreemodel.iter_n_children(None) - 1)
-			it = self._instance._results_view.findResultTreemodel.get_iter(path)
+			dir_path = self.pathComboboxtext.get_active_text()
+			file_pattern = self.filterComboboxtext.get_active_text()
+			self._instance.find_all_in_dir(it, dir_path, file_pattern, search_pattern, self._instance.find_options, True)
 			self._instance._results_view.show_find_result()
-			self._instance._results_view.findResultTreemodel.set_value(it, 2, _("Replace in this scope is not supported."))
 		elif self._instance.scopeFlg == 3: #current selected text
 			self._instance.advanced_find_all_in_doc(it, doc, search_pattern, self._instance.find_options, True, True)
 			self._instance._results_view.show_find_result()
@@ -528,6 +530,18 @@ class AdvancedFindUI(object):
 		#self.do_events()
 		#self.findDialog.destroy()
 
+	def confirm_replace_in_dir(self):
+		'''Files in the directory that are not open are written on disk, so the user is asked first.'''
+		dlg = Gtk.MessageDialog(self.findDialog,
+						Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT,
+						Gtk.MessageType.QUESTION,
+						Gtk.ButtonsType.OK_CANCEL,
+						_("Replace in all matching files in %s?") % self.pathComboboxtext.get_active_text())
+		dlg.format_secondary_text(_("Files that are not open are changed on disk right away, and this cannot be undone."))
+		response = dlg.run()
+		dlg.destroy()
+		return response == Gtk.ResponseType.OK
+
 	def on_closeButton_clicked_action(self, object):
 		self.findDialog.destroy()
 		
@@ -47,10 +47,17 @@ except:
 
 
 class FindResultView(Gtk.HBox):
+	# results shown per file before a "more" row, which shows the next ones when selected
+	RESULTS_CAP = 1000
+	# line number of "more" rows, so that they sort after the results
+	MORE_ROW = 2147483647
+	
 	def __init__(self, window, result_gui_settings):
 		Gtk.HBox.__init__(self)
 		self._window = window
 		self.result_gui_settings = result_gui_settings
+		self.more_results = {}
+		self.more_results_key = 0
 
 		# load color theme of results list	
 		user_formatfile = os.path.join(CONFIG_DIR, 'theme/'+self.result_gui_settings['COLOR_THEME']+'.xml')
@@ -248,6 +255,9 @@ class FindResultView(Gtk.HBox):
 			return
 		if not it:
 			return
+		if model.get_value(it, 0) == self.MORE_ROW:
+			self.show_more_results(it)
+			return
 		
 		try:
 			m = re.search('.+(<.+>)+([0-9]+)(<.+>)+.*', model.get_value(it, 1))
@@ -474,6 +484,26 @@ class FindResultView(Gtk.HBox):
 			#result_text = (text_header + text_marked + text_footer).rstrip()
 			self.findResultTreemodel.append(parent_it, [int(line), result_line, result_text, None, result_offset_start, result_len, uri])
 		
+	def append_find_results(self, parent_it, results, replace_flg = False, shown = 0):
+		for line_num, line_text, start, length, line_start_pos in results[shown:shown + self.RESULTS_CAP]:
+			self.append_find_result(parent_it, str(line_num+1), line_text, start, length, "", line_start_pos, replace_flg)
+		shown += self.RESULTS_CAP
+		if shown < len(results):
+			key = self.more_results_key
+			self.more_results_key += 1
+			self.more_results[key] = (results, replace_flg, shown)
+			more_str = '<i>' + self.to_xml_text(_('%d more hits, select to show them') % (len(results) - shown)) + '</i>'
+			self.findResultTreemodel.append(parent_it, [self.MORE_ROW, '', more_str, None, key, 0, ''])
+			
+	def show_more_results(self, it):
+		key = self.findResultTreemodel.get_value(it, 4)
+		if key not in self.more_results:
+			return
+		results, replace_flg, shown = self.more_results.pop(key)
+		parent_it = self.findResultTreemodel.iter_parent(it)
+		self.findResultTreemodel.remove(it)
+		self.append_find_results(parent_it, results, replace_flg, shown)
+		
 	def show_find_result(self):
 		path = Gtk.TreePath.new_from_string(str(self.findResultTreemodel.iter_n_children(None) - 1))
 		self.findResultTreeview.expand_row(path, True)
@@ -485,6 +515,10 @@ class FindResultView(Gtk.HBox):
 		for i in range(0, file_cnt):
 			it1 = self.findResultTreemodel.iter_nth_child(pattern_it, i)
 			hits_cnt = self.findResultTreemodel.iter_n_children(it1)
+			last_it = self.findResultTreemodel.iter_nth_child(it1, hits_cnt - 1)
+			if last_it and self.findResultTreemodel.get_value(last_it, 0) == self.MORE_ROW:
+				results, replace_flg, shown = self.more_results[self.findResultTreemodel.get_value(last_it, 4)]
+				hits_cnt = len(results)
 			total_hits += hits_cnt
 			hits_str = self.result_format['HITS_CNT'] % {'HITS_CNT' : str(hits_cnt)}
 			#hits_str = str(hits_cnt) + ' hits'
@@ -506,8 +540,10 @@ class FindResultView(Gtk.HBox):
 			vadj_value = vadj.get_value()
 		except:
 			self.findResultTreemodel.clear()
+			self.more_results = {}
 			return
 		self.findResultTreemodel.clear()
+		self.more_results = {}
 		vadj.set_value(vadj_value)
 		
 	def get_show_button_option(self):
@@ -0,0 +1,101 @@
+# -*- encoding:utf-8 -*-
+
+
+# line_index.py is part of advancedfind-gedit
+#
+#
+# Copyright 2010-2012 swatch
+#
+# advancedfind-gedit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+
+
+import re
+from bisect import bisect_right
+from itertools import accumulate
+
+
+# the line delimiters of Gtk.TextBuffer
+LINE_END = re.compile('\r\n|\r|\n|\u2029')
+
+
+class LineIndex:
+	'''Start offsets of all lines of a text, to map match offsets to lines without text iters.'''
+	def __init__(self, text):
+		self.text_len = len(text)
+		self.starts = [0]
+		if '\r' in text or '\u2029' in text:
+			self.starts.extend([m.end() for m in LINE_END.finditer(text)])
+		else:
+			# only \n: the line lengths come from split, which is several times faster
+			self.starts.extend(accumulate([len(line) + 1 for line in text.split('\n')]))
+			self.starts.pop()
+		
+	def line_count(self):
+		return len(self.starts)
+
+	def line_at(self, offset):
+		return bisect_right(self.starts, offset) - 1
+		
+	def line_start(self, line):
+		return self.starts[line]
+		
+	# offset of the start of the next line, or the end of the text for the last line
+	def line_end(self, line):
+		if line + 1 < len(self.starts):
+			return self.starts[line + 1]
+		return self.text_len
+
+
+class MatchResults:
+	'''Matches of one search in a text, as (line_num, line_text, start, length, line_start_pos) results.
+	A result is only built when it is read, so a search with many hits only builds the ones shown.'''
+	def __init__(self, text, spans, end_pos = None):
+		self.text = text
+		self.spans = spans
+		if end_pos == None:
+			end_pos = len(text)
+		self.end_pos = end_pos
+		self.lines = None
+		
+	def __len__(self):
+		return len(self.spans)
+		
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self.result(span) for span in self.spans[index]]
+		return self.result(self.spans[index])
+		
+	def result(self, span):
+		if not self.lines:
+			self.lines = LineIndex(self.text)
+		start, end = span
+		line_num = self.lines.line_at(start)
+		line_start_pos = self.lines.line_start(line_num)
+		end_line = self.lines.line_at(end)
+		if end_line == self.lines.line_count() - 1:
+			line_end_pos = self.end_pos
+		else:
+			line_end_pos = self.lines.line_start(end_line + 1)
+		return (line_num, self.text[line_start_pos:line_end_pos], start, end - start, line_start_pos)
+		
+
+def find_results(text, regex, start_pos = 0, end_pos = None):
+	'''MatchResults of all matches of regex between start_pos and end_pos.'''
+	if end_pos == None:
+		end_pos = len(text)
+	spans = [match.span() for match in regex.finditer(text, start_pos, end_pos)]
+	return MatchResults(text, spans, end_pos)
@@ -0,0 +1,209 @@
+# -*- encoding:utf-8 -*-
+
+
+# multi_file.py is part of advancedfind-gedit
+#
+#
+# Copyright 2010-2012 swatch
+#
+# advancedfind-gedit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+
+
+
+import os
+import mmap
+import time
+import shutil
+import tempfile
+import threading
+import queue
+
+from .line_index import MatchResults, find_results
+
+
+def read_file_text(file_path, strict = False):
+	'''Decodes a file as utf-8 straight from a memory mapping. Undecodable bytes are replaced, or raise UnicodeDecodeError with strict.'''
+	f = open(file_path, 'rb')
+	try:
+		if os.fstat(f.fileno()).st_size == 0:
+			return ''
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		f.close()
+	try:
+		if strict:
+			return str(mm, 'utf-8')
+		return str(mm, 'utf-8', 'replace')
+	finally:
+		mm.close()
+		
+def write_file_text(file_path, text):
+	'''Replaces the file a path points to by a new one with the same mode and owner, so that it is never left half written.
+	A file with other hard links, or whose owner cannot be kept, is written in place.'''
+	file_path = os.path.realpath(file_path)
+	st = os.stat(file_path)
+	if st.st_nlink > 1:
+		write_file_in_place(file_path, text)
+		return
+	fd, temp_path = tempfile.mkstemp(prefix = '.' + os.path.basename(file_path) + '.', dir = os.path.dirname(file_path))
+	try:
+		with os.fdopen(fd, 'w', encoding = 'utf-8', newline = '') as f:
+			f.write(text)
+			temp_st = os.fstat(f.fileno())
+		if (temp_st.st_uid, temp_st.st_gid) != (st.st_uid, st.st_gid):
+			try:
+				os.chown(temp_path, st.st_uid, st.st_gid)
+			except OSError:
+				os.unlink(temp_path)
+				write_file_in_place(file_path, text)
+				return
+		shutil.copymode(file_path, temp_path)
+		os.replace(temp_path, file_path)
+	except:
+		if os.path.exists(temp_path):
+			os.unlink(temp_path)
+		raise
+		
+def write_file_in_place(file_path, text):
+	'''Overwrites a file, keeping its inode and so its links, mode and owner.'''
+	with open(file_path, 'w', encoding = 'utf-8', newline = '') as f:
+		f.write(text)
+		
+def replace_results(text, regex, replace_text, expand):
+	'''The replaced text, and MatchResults of the replacements in it.'''
+	pieces = []
+	replaced = []
+	last = 0
+	new_pos = 0
+	for match in regex.finditer(text):
+		if match.start() == match.end():
+			continue
+		if expand:
+			new_text = match.expand(replace_text)
+		else:
+			new_text = replace_text
+		pieces.append(text[last:match.start()])
+		new_pos += match.start() - last
+		replaced.append((new_pos, new_pos + len(new_text)))
+		pieces.append(new_text)
+		new_pos += len(new_text)
+		last = match.end()
+	if not replaced:
+		return text, []
+	pieces.append(text[last:])
+	text = ''.join(pieces)
+	return text, MatchResults(text, replaced)
+	
+
+class MultiFileEngine:
+	'''Finds, or replaces, a regex in many files with a pool of worker threads.
+	The main thread takes the per file results with take_results(), in the order of the file list.'''
+	def __init__(self, file_list, regex, replace_text = None, expand = False, workers = None):
+		self.file_list = file_list
+		self.regex = regex
+		self.replace_text = replace_text
+		self.expand = expand
+		
+		self.todo = queue.Queue()
+		for i in range(len(file_list)):
+			self.todo.put(i)
+		self.done = queue.Queue()
+		self.pending = {}
+		self.next_index = 0
+		self.done_cnt = 0
+		self.bytes_cnt = 0
+		self.errors = []
+		self.cancelled = threading.Event()
+		self.start_time = time.time()
+		
+		if not workers:
+			workers = min(os.cpu_count() or 1, 8)
+		workers = max(1, min(workers, len(file_list)))
+		self.threads = []
+		for i in range(workers):
+			thread = threading.Thread(target = self.work)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+			
+	def cancel(self):
+		self.cancelled.set()
+		
+	def is_finished(self):
+		for thread in self.threads:
+			if thread.is_alive():
+				return False
+		return self.done.empty()
+		
+	def wait(self, timeout):
+		try:
+			self.pending_put(self.done.get(True, timeout))
+		except queue.Empty:
+			pass
+			
+	def pending_put(self, item):
+		index, file_path, results, size = item
+		self.pending[index] = (file_path, results)
+		self.done_cnt += 1
+		self.bytes_cnt += size
+			
+	def take_results(self):
+		'''(file_path, results) of the finished files that follow the ones taken before.'''
+		while True:
+			try:
+				self.pending_put(self.done.get_nowait())
+			except queue.Empty:
+				break
+		taken = []
+		while self.next_index in self.pending:
+			taken.append(self.pending.pop(self.next_index))
+			self.next_index += 1
+		if self.cancelled.is_set() and self.is_finished():
+			# files skipped after the cancel leave gaps
+			for index in sorted(self.pending):
+				taken.append(self.pending.pop(index))
+		return taken
+		
+	def progress(self):
+		'''(files done, files total, files per second, megabytes per second)'''
+		elapsed = max(time.time() - self.start_time, 0.001)
+		return (self.done_cnt, len(self.file_list), self.done_cnt / elapsed, self.bytes_cnt / elapsed / 1048576)
+		
+	def work(self):
+		while not self.cancelled.is_set():
+			try:
+				index = self.todo.get_nowait()
+			except queue.Empty:
+				return
+			file_path = self.file_list[index]
+			results = []
+			size = 0
+			try:
+				if self.replace_text == None:
+					text = read_file_text(file_path)
+					results = find_results(text, self.regex)
+				else:
+					text = read_file_text(file_path, True)
+					new_text, results = replace_results(text, self.regex, self.replace_text, self.expand)
+					if results:
+						write_file_text(file_path, new_text)
+				size = len(text)
+			except (IOError, OSError, ValueError) as e:
+				# UnicodeDecodeError is a ValueError: such files are not rewritten
+				self.errors.append((file_path, str(e)))
+				results = []
+			self.done.put((index, file_path, results, size))
@@ -0,0 +1,63 @@
+# -*- encoding:utf-8 -*-
+
+
+# regex_cache.py is part of advancedfind-gedit
+#
+#
+# Copyright 2010-2012 swatch
+#
+# advancedfind-gedit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+
+
+from collections import OrderedDict
+
+
+class RegexCache:
+	'''Bounded LRU of compiled regular expressions, keyed by the search pattern and the find options.'''
+	def __init__(self, size = 64):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self.regexes = OrderedDict()
+		
+	def key(self, pattern, options):
+		return (pattern, options['REGEX_SEARCH'], options['MATCH_WHOLE_WORD'], options['MATCH_CASE'])
+		
+	def get(self, key):
+		regex = self.regexes.get(key)
+		if regex is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self.regexes.move_to_end(key)
+		return regex
+		
+	def put(self, key, regex):
+		self.regexes[key] = regex
+		self.regexes.move_to_end(key)
+		while len(self.regexes) > self.size:
+			self.regexes.popitem(last = False)
+			
+	def clear(self):
+		self.regexes.clear()
+		self.hits = 0
+		self.misses = 0
+		
+		
+# shared by all windows
+regex_cache = RegexCache()
+
@@ -24,7 +24,7 @@
 
 
 
-from gi.repository import Gtk, Gdk, Gedit
+from gi.repository import Gtk, Gdk, Gedit, GLib
 import re
 import os.path
 #import pango
@@ -32,6 +32,7 @@ import shutil
 
 from . import config_manager
 from .config_ui import ConfigUI
+from .regex_cache import regex_cache
 
 import gettext
 APP_NAME = 'smart_highlight'		#Same as module name defined at .plugin file.
@@ -72,18 +73,21 @@ ui_str = """<ui>
 
 
 class SmartHighlightWindowHelper:
+	# milliseconds without selection changes before highlighting, so dragging a selection highlights once
+	HIGHLIGHT_DELAY = 100
+
 	def __init__(self, plugin, window):
 		self._window = window
 		self._plugin = plugin
 		self.current_selection = ''
-		self.start_iter = None
-		self.end_iter = None
-		self.vadj_value = 0
+		self.highlight_doc = None
+		self.highlight_regex = None
+		self.highlight_extra_lines = 0		# lines a match can span beyond the line it starts on
+		self.highlighted_lines = []		# sorted, disjoint [start, end) line ranges of highlight_doc already highlighted
+		self.highlight_timeout_id = None
 		views = self._window.get_views()
 		for view in views:
-			view.get_buffer().connect('mark-set', self.on_textbuffer_markset_event)
-			view.get_vadjustment().connect('value-changed', self.on_view_vadjustment_value_changed)
-			#view.connect('button-press-event', self.on_view_button_press_event)
+			self.connect_view(view)
 		self.active_tab_added_id = self._window.connect("tab-added", self.tab_added_action)
 
 		user_configfile = os.path.join(CONFIG_DIR, 'config.xml')
@@ -156,6 +160,11 @@ class SmartHighlightWindowHelper:
 		
 		
 	def create_regex(self, pattern, options):
+		key = regex_cache.key(pattern, options)
+		regex = regex_cache.get(key)
+		if regex:
+			return regex
+		
 		if options['REGEX_SEARCH'] == False:
 			pattern = re.escape(str(r'%s' % pattern))
 		else:
@@ -169,50 +178,104 @@ class SmartHighlightWindowHelper:
 		else:
 			regex = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
 		
+		regex_cache.put(key, regex)
 		return regex
 
-	def smart_highlighting_action(self, doc, search_pattern, iter, clear_flg = True):
-		regex = self.create_regex(search_pattern, self.options)
-		if clear_flg == True:
-			self.smart_highlight_off(doc)
+	def smart_highlighting_action(self, doc, search_pattern):
+		self.smart_highlight_off(doc)
+		self.highlight_doc = doc
+		self.highlight_regex = self.create_regex(search_pattern, self.options)
+		self.highlight_extra_lines = search_pattern.count('\n')
+		self.highlight_visible_lines(self._window.get_active_view())
 		
-		self.vadj_value = self._window.get_active_view().get_vadjustment().get_value()
-		current_line = iter.get_line()
-		start_line = current_line - 50
-		end_line = current_line + 50
-		if start_line <= 0:
-			self.start_iter = doc.get_start_iter()
-		else:
-			self.start_iter = doc.get_iter_at_line(start_line)
+	def highlight_visible_lines(self, view):
+		if not self.highlight_regex or not view or view.get_buffer() != self.highlight_doc:
+			return
+		rect = view.get_visible_rect()
+		first_line = view.get_line_at_y(rect.y)[0].get_line()
+		last_line = view.get_line_at_y(rect.y + rect.height)[0].get_line()
+		# only the lines that were not visible before are searched
+		for start_line, end_line in self.add_highlighted_lines(first_line, last_line + 1):
+			self.highlight_lines(self.highlight_doc, start_line, end_line)
+			
+	def add_highlighted_lines(self, start_line, end_line):
+		'''Adds [start_line, end_line) to highlighted_lines and returns the parts of it that were not there yet.'''
+		new_ranges = []
+		merged = []
+		pos = start_line
+		for start, end in self.highlighted_lines:
+			if end < start_line or start > end_line:
+				merged.append((start, end))
+				continue
+			if start > pos:
+				new_ranges.append((pos, start))
+			pos = max(pos, end)
+			start_line = min(start_line, start)
+			end_line = max(end_line, end)
+		if pos < end_line:
+			new_ranges.append((pos, end_line))
+		merged.append((start_line, end_line))
+		merged.sort()
+		self.highlighted_lines = merged
+		return new_ranges
+		
+	def highlight_lines(self, doc, start_line, end_line):
+		start = doc.get_iter_at_line(start_line)
 		if end_line < doc.get_line_count():
-			self.end_iter = doc.get_iter_at_line(end_line)
+			limit = doc.get_iter_at_line(end_line).get_offset() - start.get_offset()
 		else:
-			self.end_iter = doc.get_end_iter()
-			
-		text = str(doc.get_text(self.start_iter, self.end_iter, True))
+			limit = doc.get_char_count() - start.get_offset()
+		if end_line + self.highlight_extra_lines < doc.get_line_count():
+			end = doc.get_iter_at_line(end_line + self.highlight_extra_lines)
+		else:
+			end = doc.get_end_iter()
+		text = str(doc.get_text(start, end, True))
+		offset = start.get_offset()
 		
-		match = regex.search(text)
-		while(match):
-			self.smart_highlight_on(doc, match.start()+self.start_iter.get_offset(), match.end() - match.start())
-			match = regex.search(text, match.end()+1)
+		# matches starting on the next lines belong to the range of those lines
+		for match in self.highlight_regex.finditer(text):
+			if match.start() >= limit:
+				break
+			if match.start() == match.end():
+				continue
+			self.smart_highlight_on(doc, match.start() + offset, match.end() - match.start())
 			
-	def tab_added_action(self, action, tab):
-		view = tab.get_view()
+	def connect_view(self, view):
 		view.get_buffer().connect('mark-set', self.on_textbuffer_markset_event)
-		view.get_vadjustment().connect('value-changed', self.on_view_vadjustment_value_changed)
+		view.get_buffer().connect('changed', self.on_textbuffer_changed_event)
+		view.get_vadjustment().connect('value-changed', self.on_view_vadjustment_value_changed, view)
 		#view.connect('button-press-event', self.on_view_button_press_event)
+			
+	def tab_added_action(self, action, tab):
+		self.connect_view(tab.get_view())
 	
 	def on_textbuffer_markset_event(self, textbuffer, iter, textmark):
 		#print textmark.get_name()
 		if textmark.get_name() != 'selection_bound' and textmark.get_name() != 'insert':
 			return
+		if self.highlight_timeout_id:
+			GLib.source_remove(self.highlight_timeout_id)
+		self.highlight_timeout_id = GLib.timeout_add(self.HIGHLIGHT_DELAY, self.on_highlight_timeout, textbuffer)
+		
+	def on_highlight_timeout(self, textbuffer):
+		self.highlight_timeout_id = None
 		if textbuffer.get_selection_bounds():
 			start, end = textbuffer.get_selection_bounds()
-			self.current_selection = textbuffer.get_text(start, end, True)
-			self.smart_highlighting_action(textbuffer, self.current_selection, iter)
-		else:
- 			self.current_selection = ''
- 			self.smart_highlight_off(textbuffer)
+			selection = textbuffer.get_text(start, end, True)
+			if selection != self.current_selection or textbuffer != self.highlight_doc:
+				self.current_selection = selection
+				self.smart_highlighting_action(textbuffer, self.current_selection)
+			else:
+				self.highlight_visible_lines(self._window.get_active_view())
+		elif self.current_selection != '':
+			self.current_selection = ''
+			self.smart_highlight_off(textbuffer)
+		return False
+		
+	def on_textbuffer_changed_event(self, textbuffer):
+		# line numbers of the highlighted ranges may have moved
+		if textbuffer == self.highlight_doc:
+			self.highlighted_lines = []
 	
 	def smart_highlight_on(self, doc, highlight_start, highlight_len):
 		if doc.get_tag_table().lookup('smart_highlight') == None:
@@ -220,6 +283,10 @@ class SmartHighlightWindowHelper:
 		doc.apply_tag_by_name('smart_highlight', doc.get_iter_at_offset(highlight_start), doc.get_iter_at_offset(highlight_start + highlight_len))
 		
 	def smart_highlight_off(self, doc):
+		if doc == self.highlight_doc:
+			self.highlight_doc = None
+			self.highlight_regex = None
+			self.highlighted_lines = []
 		start, end = doc.get_bounds()
 		if doc.get_tag_table().lookup('smart_highlight') == None:
 			tag = doc.create_tag("smart_highlight", foreground=self.smart_highlight['FOREGROUND_COLOR'], background=self.smart_highlight['BACKGROUND_COLOR'])
@@ -231,10 +298,7 @@ class SmartHighlightWindowHelper:
 	def on_view_vadjustment_value_changed(self, object, data = None):
 		if self.current_selection == '':
 			return
-		if object.get_value() < self.vadj_value:	#scroll up
-			self.smart_highlighting_action(self._window.get_active_document(), self.current_selection, self.start_iter, False)
-		else:	#scroll down
-			self.smart_highlighting_action(self._window.get_active_document(), self.current_selection, self.end_iter, False)
+		self.highlight_visible_lines(data)
 
 			
 